@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import datetime
 import json
+import threading
 import requests
 
 try:
@@ -14,6 +15,9 @@ from requests_oauthlib import OAuth2Session
 
 import exceptions
 from compliance import fitbit_compliance_fix
+from decoding import loads_json
+from response_cache import ResponseCache
+from transport import RateLimiter, RetryPolicy, Transport
 from utils import curry
 
 
@@ -37,6 +41,8 @@ class FitbitOauth2Client(object):
             - client_id, client_secret are in the app configuration page
             https://dev.fitbit.com/apps
             - access_token, refresh_token are obtained after the user grants permission
+            - optional transport keyword arguments (see transport.py):
+              pool_maxsize, max_retries, backoff_factor, rate_limit_reserve
         """
 
         self.client_id, self.client_secret = client_id, client_secret
@@ -56,16 +62,24 @@ class FitbitOauth2Client(object):
             redirect_uri=redirect_uri,
         ))
         self.timeout = kwargs.get("timeout", None)
+        self.transport = Transport(
+            self.session,
+            pool_maxsize=kwargs.get("pool_maxsize", 10),
+            retry=RetryPolicy(max_retries=kwargs.get("max_retries", 5),
+                              backoff_factor=kwargs.get("backoff_factor", 1.0)),
+            rate_limiter=RateLimiter(reserve=kwargs.get("rate_limit_reserve", 0)),
+        )
 
     def _request(self, method, url, **kwargs):
         """
-        A simple wrapper around requests.
+        A wrapper around requests that goes through the pooled, retrying
+        and rate limited transport.
         """
         if self.timeout is not None and 'timeout' not in kwargs:
             kwargs['timeout'] = self.timeout
 
         try:
-            response = self.session.request(method, url, **kwargs)
+            response = self.transport.request(method, url, **kwargs)
 
             # If our current token has no expires_at, or something manages to slip
             # through that check
@@ -73,7 +87,7 @@ class FitbitOauth2Client(object):
                 d = json.loads(response.content.decode('utf8'))
                 if d['errors'][0]['errorType'] == 'expired_token':
                     self.refresh_token()
-                    response = self.session.request(method, url, **kwargs)
+                    response = self.transport.request(method, url, **kwargs)
 
             return response
         except requests.Timeout as e:
@@ -211,11 +225,20 @@ class Fitbit(object):
 
     def __init__(self, client_id, client_secret, access_token=None,
             refresh_token=None, expires_at=None, refresh_cb=None,
-            redirect_uri=None, system=US, **kwargs):
+            redirect_uri=None, system=US, cache=None, decoder=loads_json, **kwargs):
         """
         Fitbit(<id>, <secret>, access_token=<token>, refresh_token=<token>)
+            - cache: ResponseCache, or the path of one, to answer GET
+              requests from before hitting the API (see response_cache.py)
+            - decoder: function from a response's bytes to its JSON, e.g.
+              decoding.loads_fast
         """
         self.system = system
+        self.decoder = decoder
+        if cache is not None and not isinstance(cache, ResponseCache):
+            cache = ResponseCache(cache)
+        self.cache = cache
+        self._local = threading.local()
         self.client = FitbitOauth2Client(
             client_id,
             client_secret,
@@ -253,6 +276,14 @@ class Fitbit(object):
         kwargs['headers'] = headers
 
         method = kwargs.get('method', 'POST' if 'data' in kwargs else 'GET')
+        url = args[0] if args else kwargs.get('url')
+        cached = method == 'GET' and self.cache is not None
+        if cached:
+            content = self.cache.get(url, self.system)
+            if content is not None:
+                return self.decoder(content)
+
+        self._local.api_requests = self.api_requests() + 1
         response = self.client.make_request(*args, **kwargs)
 
         if response.status_code == 202:
@@ -263,12 +294,18 @@ class Fitbit(object):
             else:
                 raise exceptions.DeleteError(response)
         try:
-            rep = json.loads(response.content.decode('utf8'))
+            rep = self.decoder(response.content)
         except ValueError:
             raise exceptions.BadResponse
 
+        if cached and response.status_code == 200:
+            self.cache.put(url, response.content, self.system)
         return rep
 
+    def api_requests(self):
+        """ Number of requests this thread has sent to the API, cache hits aren't counted """
+        return getattr(self._local, 'api_requests', 0)
+
     def user_profile_get(self, user_id=None):
         """
         Get a user profile. You can get other user's profile information
@@ -810,6 +847,18 @@ class Fitbit(object):
         )
         return self.make_request(url)
 
+    def get_spo2_intraday(self, date):
+        """
+        https://dev.fitbit.com/build/reference/web-api/spo2/get-spo2-intraday-by-date/
+        SpO2 readings, one a minute, of the sleep that ended on date. Only
+        version 1 of the API has this endpoint.
+        """
+        url = "{0}/1/user/-/spo2/date/{date}/all.json".format(
+            self.API_ENDPOINT,
+            date=self._get_date_string(date)
+        )
+        return self.make_request(url)
+
     def log_sleep(self, start_time, duration):
         """
         https://dev.fitbit.com/docs/sleep/#log-sleep
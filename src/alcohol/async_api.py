@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio front end for the Fitbit client.
+
+aiohttp isn't a dependency of this package, so AsyncFitbit awaits the
+synchronous client's requests in a thread pool. The client's transport is
+pooled, retrying and thread safe (see transport.py), and a token bucket
+keeps the request rate within Fitbit's hourly limit, so many days and
+resources can be in flight at once.
+"""
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from api import Fitbit
+
+# Fitbit's limit per user and app
+REQUESTS_PER_HOUR = 150
+
+
+class TokenBucket(object):
+    """
+    Allows bursts of up to `capacity` requests, refilled at `rate` requests
+    per second.
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+        self._lock = None
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """ Wait for a token and take it """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # Waiters queue on the lock, so tokens are handed out in order
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    def refund(self):
+        """ Give back a token that wasn't used for a request """
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class AsyncFitbit(object):
+    """
+    Takes the same arguments as Fitbit, and has the same methods, except
+    that they are coroutines:
+
+        async with AsyncFitbit(client_id, client_secret, ...) as client:
+            result = await client.intraday_time_series('activities/heart', base_date=day)
+
+        - max_concurrency: requests in flight at once, also the size of the
+          connection pool
+        - requests_per_hour, burst: token bucket rate and capacity
+    """
+
+    def __init__(self, *args, max_concurrency=8, requests_per_hour=REQUESTS_PER_HOUR,
+                 burst=None, **kwargs):
+        kwargs.setdefault('pool_maxsize', max_concurrency)
+        self.fitbit = Fitbit(*args, **kwargs)
+        self.bucket = TokenBucket(requests_per_hour / 3600.0,
+                                  burst if burst is not None else requests_per_hour)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def __getattr__(self, name):
+        attr = getattr(self.fitbit, name)
+        if not callable(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            await self.bucket.acquire()
+            loop = asyncio.get_running_loop()
+            result, no_request = await loop.run_in_executor(
+                self.executor, functools.partial(self._call, attr, *args, **kwargs))
+            if no_request:
+                self.bucket.refund()
+            return result
+        return call
+
+    def _call(self, method, *args, **kwargs):
+        """ Runs in the executor, also says if the call sent no request to the API """
+        before = self.fitbit.api_requests()
+        result = method(*args, **kwargs)
+        return result, self.fitbit.api_requests() == before
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
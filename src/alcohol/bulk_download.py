@@ -0,0 +1,142 @@
+# First run python3 authorize_fitbit.py
+"""
+Downloads intraday Fitbit data for a range of days and several resources
+concurrently, and writes one CSV per resource.
+"""
+import argparse
+import asyncio
+import os
+
+import pandas as pd
+
+from async_api import AsyncFitbit, REQUESTS_PER_HOUR
+from decoding import intraday_arrays, loads_fast, loads_json
+
+
+def read_credentials(credentials_fn, tokens_fn):
+    """
+    Reads the app's client id and secret, and the tokens saved by
+    authorize_fitbit.py, as keyword arguments for Fitbit
+    """
+    with open(credentials_fn) as fp:
+        lines = fp.readlines()
+    credentials = {'client_id': lines[0].strip(), 'client_secret': lines[1].strip()}
+    with open(tokens_fn) as fp:
+        lines = fp.readlines()
+    credentials.update(access_token=lines[0].strip(),
+                       refresh_token=lines[1].strip(),
+                       expires_at=float(lines[2].strip()))
+    return credentials
+
+
+def use_api_endpoint(fitbit, endpoint):
+    """
+    Points a Fitbit client at another API, e.g. a local mock. oauthlib
+    refuses plain http unless OAUTHLIB_INSECURE_TRANSPORT is set, so it is
+    set for an http:// endpoint.
+    """
+    fitbit.API_ENDPOINT = endpoint
+    if endpoint.startswith('http://'):
+        os.environ.setdefault('OAUTHLIB_INSECURE_TRANSPORT', '1')
+
+
+def intraday_frame(result, resource, date):
+    """
+    The dataset of an intraday_time_series response: time (seconds of the
+    day), value and date
+    """
+    times, values = intraday_arrays(result, resource)
+    return pd.DataFrame({'time': times, 'value': values, 'date': date})
+
+
+async def download(client, resources, dates, detail_level='1min'):
+    """
+    Fetches every (resource, day) at once, the client's token bucket and
+    rate limiter pace the requests
+
+    Returns: {resource: dataframe of all days}
+    """
+    keys = [(resource, date) for resource in resources for date in dates]
+    results = await asyncio.gather(*[
+        client.intraday_time_series(resource, base_date=date, detail_level=detail_level)
+        for resource, date in keys])
+
+    frames = {resource: [] for resource in resources}
+    for (resource, date), result in zip(keys, results):
+        frames[resource].append(intraday_frame(result, resource, date))
+    return {resource: pd.concat(frames[resource], ignore_index=True)
+            for resource in resources}
+
+
+async def run(args):
+    credentials = read_credentials(args.credentials, args.tokens)
+    dates = pd.date_range(start=args.start, end=args.end)
+    async with AsyncFitbit(max_concurrency=args.concurrency,
+                           requests_per_hour=args.requests_per_hour,
+                           cache=args.cache,
+                           decoder=loads_fast if args.fast_json else loads_json,
+                           **credentials) as client:
+        if args.api_endpoint:
+            use_api_endpoint(client.fitbit, args.api_endpoint)
+        frames = await download(client, args.resources, dates, args.detail_level)
+        if client.cache is not None:
+            print("Response cache: {hits} hits, {misses} misses".format(**client.cache.stats()))
+
+    for resource, df in frames.items():
+        out_fn = os.path.join(args.out_dir, "{}_{}_{}_{}.csv".format(
+            resource.replace('/', '_'), dates[0].strftime('%Y%m%d'),
+            dates[-1].strftime('%Y%m%d'), args.detail_level))
+        df.to_csv(out_fn)
+        print("Wrote {} rows to {}".format(len(df), out_fn))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--start", help="First day to download", required=True)
+    parser.add_argument("--end", help="Last day to download", required=True)
+    parser.add_argument(
+        "--resources",
+        help="Intraday resources to download",
+        nargs="+",
+        default=["activities/heart"])
+    parser.add_argument(
+        "--detail_level",
+        help="Intraday detail level",
+        choices=["1sec", "1min", "15min"],
+        default="1min")
+    parser.add_argument(
+        "--credentials",
+        help="File with the app's client id and secret",
+        default="/Users/kmcmanus/Documents/classes/digitalhealth_project/data/keys/fitbit_credentials.txt")
+    parser.add_argument(
+        "--tokens",
+        help="File with the tokens saved by authorize_fitbit.py",
+        default="/Users/kmcmanus/Documents/classes/digitalhealth_project/data/keys/temp_creds.txt")
+    parser.add_argument(
+        "--out_dir",
+        help="Output directory",
+        default="/Users/kmcmanus/Documents/classes/digitalhealth_project/data/alcohol")
+    parser.add_argument(
+        "--concurrency",
+        help="Requests in flight at once",
+        type=int,
+        default=8)
+    parser.add_argument(
+        "--requests_per_hour",
+        help="Token bucket rate, Fitbit allows 150 requests an hour",
+        type=int,
+        default=REQUESTS_PER_HOUR)
+    parser.add_argument(
+        "--cache",
+        help="SQLite file to cache responses in, days already downloaded are not fetched again",
+        default=None)
+    parser.add_argument(
+        "--fast_json",
+        help="Decode responses with orjson, if it is installed",
+        action="store_true")
+    parser.add_argument(
+        "--api_endpoint",
+        help="API to download from instead of api.fitbit.com, e.g. a local mock. "
+             "Plain http is allowed for it",
+        default=None)
+    asyncio.run(run(parser.parse_args()))
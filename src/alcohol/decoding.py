@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Faster decoding of Fitbit responses.
+
+    - loads_fast: a response decoder for Fitbit(decoder=loads_fast), orjson
+      when it is installed (pip install orjson), the json module otherwise
+    - intraday_arrays: the dataset of an intraday time series as two NumPy
+      arrays, seconds of the day and values, rather than a dataframe made by
+      pd.json_normalize
+"""
+import json
+from operator import itemgetter
+
+import numpy as np
+
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# Value dtypes of the intraday time series
+INTRADAY_DTYPES = {
+    'activities/heart': np.int16,
+    'activities/steps': np.int16,
+    'activities/floors': np.int16,
+    'activities/elevation': np.float32,
+    'activities/calories': np.float32,
+    'activities/distance': np.float32,
+}
+
+
+def loads_json(content):
+    """ Fitbit's default decoder """
+    return json.loads(content.decode('utf8'))
+
+
+def loads_fast(content):
+    if HAS_ORJSON:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def seconds_of_day(times):
+    """ "HH:MM:SS" strings to int32 seconds since midnight """
+    digits = (np.array(times, dtype='S8').view(np.uint8).reshape(-1, 8)
+              .astype(np.int32) - ord('0'))
+    return ((digits[:, 0] * 10 + digits[:, 1]) * 3600 +
+            (digits[:, 3] * 10 + digits[:, 4]) * 60 +
+            digits[:, 6] * 10 + digits[:, 7])
+
+
+def intraday_arrays(result, resource):
+    """
+    The dataset of an intraday_time_series result as (times, values): int32
+    seconds of the day, and values as INTRADAY_DTYPES[resource] (float64 for
+    resources not listed)
+    """
+    dataset = result[resource.replace('/', '-') + '-intraday']['dataset']
+    times = seconds_of_day(list(map(itemgetter('time'), dataset)))
+    values = np.fromiter(map(itemgetter('value'), dataset),
+                         dtype=INTRADAY_DTYPES.get(resource, np.float64), count=len(dataset))
+    return times, values
@@ -1,7 +1,6 @@
 # First run python3 authorize_fitbit.py
 import pandas as pd
 import json
-import time
 
 # Get secrets
 with open("/Users/kmcmanus/Documents/classes/digitalhealth_project/data/keys/fitbit_credentials.txt") as fp:
@@ -16,35 +15,29 @@ with open("/Users/kmcmanus/Documents/classes/digitalhealth_project/data/keys/tem
     expires_at = float(lines[2].strip())
 
 from api import Fitbit
+from extraction_job import ExtractionJob, save_tokens
+from query_planner import Query, fetch
+# No sleeps between requests, the client's transport paces them by
+# Fitbit's rate limit headers and retries 429s after their Retry-After
 okk = Fitbit(client_id=client_id, client_secret=client_secret,
     access_token=access_token,
     refresh_token=refresh_token,
-    expires_at=expires_at)
+    expires_at=expires_at,
+    refresh_cb=save_tokens("/Users/kmcmanus/Documents/classes/digitalhealth_project/data/keys/temp_creds.txt"))
 
 # Get minute-by-minute heart rate
 dates = pd.date_range(start='2021-03-08', end='2021-06-09')
-final_df = pd.DataFrame(columns = ['time', 'value', 'date'])
-for date in dates:
-    result = okk.intraday_time_series('activities/heart',
-        base_date=date, detail_level='1min',
-        start_time=None, end_time=None)
-
-    df_nested_list = pd.json_normalize(result['activities-heart-intraday'], record_path =['dataset'])
-    df_nested_list["date"] = date
-    final_df = final_df.append(df_nested_list)
-    time.sleep(3)
+# Each day is saved as it is fetched, if this dies partway through run it
+# again and it picks up at the first missing day. For many days,
+# bulk_download.py fetches them concurrently.
+job = ExtractionJob(okk, "/Users/kmcmanus/Documents/classes/digitalhealth_project/data/alcohol/hr_job",
+    ['heart'], dates, detail_level='1min')
+job.run()
+final_df = job.combine('heart')
 
 final_df.to_csv("/Users/kmcmanus/Documents/classes/digitalhealth_project/data/alcohol/hr_data_20210308_20210609_1min.csv")
 
-# Get daily resting heart rate
-resting_hr_df = pd.DataFrame(columns = ['time', 'value', 'date'])
-result_hr = okk.time_series('activities/heart', period='7d', base_date=date)
-print(result_hr)
-
-hr_df = pd.json_normalize(result_hr['activities-heart'])
-hr_df.rename(columns={'dateTime': 'date',
-    'value.restingHeartRate': 'restingHeartRate'}, inplace=True)
-hr_df.drop(columns=['value.customHeartRateZones',
-        'value.heartRateZones'], inplace=True)
-hr_df.to_csv("/Users/kmcmanus/Documents/classes/digitalhealth_project/data/alcohol/hr_data_20210308_6m_restinghr.csv")
-
+# Get daily resting heart rate, for the same days in one call
+hr_df = fetch(okk, [Query('activities/heart', dates[0], dates[-1], '1d')])
+hr_df = hr_df.rename(columns={'time': 'date', 'value': 'restingHeartRate'})
+hr_df[['date', 'restingHeartRate']].to_csv("/Users/kmcmanus/Documents/classes/digitalhealth_project/data/alcohol/hr_data_20210308_20210609_restinghr.csv")
@@ -0,0 +1,220 @@
+# First run python3 authorize_fitbit.py
+"""
+Resumable extraction of daily Fitbit data. Every (resource, day) fetched is
+written straight away as its own partition, out_dir/<resource>/<day>.csv,
+and recorded in out_dir/checkpoint.json. If the job dies (expired token,
+quota, network), running it again fetches only the days still missing.
+"""
+import argparse
+import json
+import os
+
+import pandas as pd
+
+from api import Fitbit
+from bulk_download import intraday_frame, read_credentials, use_api_endpoint
+
+CHECKPOINT = 'checkpoint.json'
+
+
+def fetch_heart(client, date, detail_level):
+    result = client.intraday_time_series('activities/heart', base_date=date,
+                                         detail_level=detail_level)
+    return intraday_frame(result, 'activities/heart', date)
+
+
+def fetch_steps(client, date, detail_level):
+    result = client.intraday_time_series('activities/steps', base_date=date,
+                                         detail_level=detail_level)
+    return intraday_frame(result, 'activities/steps', date)
+
+
+def fetch_sleep(client, date, detail_level):
+    """ Sleep stages of the sleeps that ended on date, one row per stage """
+    result = client.get_sleep(date)
+    df = pd.json_normalize(result['sleep'], record_path=[['levels', 'data']],
+                           meta=['logId', 'isMainSleep'])
+    df['date'] = date
+    return df
+
+
+def fetch_spo2(client, date, detail_level):
+    """ Minute SpO2 of the sleep that ended on date, detail_level doesn't apply """
+    result = client.get_spo2_intraday(date)
+    df = pd.json_normalize(result, record_path=['minutes'])
+    df['date'] = date
+    return df
+
+
+# Resource name: function(client, date, detail_level) returning a dataframe
+RESOURCES = {
+    'heart': fetch_heart,
+    'steps': fetch_steps,
+    'sleep': fetch_sleep,
+    'spo2': fetch_spo2,
+}
+
+
+def write_atomic(path, write):
+    """ write(tmp_path), then rename, so a partition is either whole or absent """
+    tmp_path = path + '.tmp'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+class ExtractionJob(object):
+    """
+    Fetches resources for every day of dates into partitions under out_dir.
+        - client: Fitbit, or anything with the methods RESOURCES use
+        - resources: names from RESOURCES
+        - dates: days to fetch, e.g. pd.date_range(start, end)
+    A checkpoint written with another detail_level raises ValueError, the
+    days and resources can change between runs.
+    """
+
+    def __init__(self, client, out_dir, resources, dates, detail_level='1min'):
+        unknown = set(resources) - set(RESOURCES)
+        if unknown:
+            raise ValueError("Unknown resources {}, use {}".format(
+                sorted(unknown), ', '.join(RESOURCES)))
+        self.client = client
+        self.out_dir = out_dir
+        self.resources = list(resources)
+        self.days = [pd.Timestamp(date).strftime('%Y-%m-%d') for date in dates]
+        self.detail_level = detail_level
+        self.checkpoint_fn = os.path.join(out_dir, CHECKPOINT)
+        self.done = self._read_checkpoint()
+
+    def _read_checkpoint(self):
+        if not os.path.exists(self.checkpoint_fn):
+            return {}
+        with open(self.checkpoint_fn) as fp:
+            checkpoint = json.load(fp)
+        if checkpoint['detail_level'] != self.detail_level:
+            raise ValueError("{} was written with detail_level {}, not {}".format(
+                self.checkpoint_fn, checkpoint['detail_level'], self.detail_level))
+        return {resource: set(days) for resource, days in checkpoint['done'].items()}
+
+    def _write_checkpoint(self):
+        checkpoint = {'detail_level': self.detail_level,
+                      'done': {resource: sorted(days) for resource, days in self.done.items()}}
+
+        def write(path):
+            with open(path, 'w') as fp:
+                json.dump(checkpoint, fp, indent=1)
+        write_atomic(self.checkpoint_fn, write)
+
+    def partition(self, resource, day):
+        return os.path.join(self.out_dir, resource, day + '.csv')
+
+    def pending(self):
+        """
+        (resource, day) pairs still to fetch, day by day so an interrupted
+        job has every resource up to the day it stopped at. A day counts as
+        done only if the checkpoint has it and its partition exists.
+        """
+        return [(resource, day) for day in self.days for resource in self.resources
+                if day not in self.done.get(resource, ())
+                or not os.path.exists(self.partition(resource, day))]
+
+    def run(self, progress=print):
+        """ Fetch the pending days, returns how many (resource, day) partitions were fetched """
+        for resource in self.resources:
+            os.makedirs(os.path.join(self.out_dir, resource), exist_ok=True)
+        pending = self.pending()
+        for n, (resource, day) in enumerate(pending):
+            try:
+                df = RESOURCES[resource](self.client, pd.Timestamp(day), self.detail_level)
+            except Exception:
+                progress("Stopped at {} {}, {} of {} fetched, run again to resume".format(
+                    resource, day, n, len(pending)))
+                raise
+            write_atomic(self.partition(resource, day), lambda path: df.to_csv(path, index=False))
+            self.done.setdefault(resource, set()).add(day)
+            self._write_checkpoint()
+        return len(pending)
+
+    def combine(self, resource):
+        """ The partitions of a resource's days as one dataframe, None if none has data """
+        frames = []
+        for day in self.days:
+            try:
+                frames.append(pd.read_csv(self.partition(resource, day)))
+            except pd.errors.EmptyDataError:
+                # A day without data, e.g. the tracker wasn't worn
+                continue
+        if not frames:
+            return None
+        return pd.concat(frames, ignore_index=True)
+
+
+def save_tokens(tokens_fn):
+    """
+    A refresh_cb for Fitbit that keeps tokens_fn up to date, so a resumed
+    job doesn't start from an already refreshed (and so revoked) token
+    """
+    def refresh_cb(token):
+        def write(path):
+            with open(path, 'w') as f:
+                f.write(token["access_token"] + "\n")
+                f.write(token["refresh_token"] + "\n")
+                f.write(str(token["expires_at"]))
+        write_atomic(tokens_fn, write)
+    return refresh_cb
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--start", help="First day to fetch", required=True)
+    parser.add_argument("--end", help="Last day to fetch", required=True)
+    parser.add_argument(
+        "--resources",
+        help="Resources to fetch",
+        nargs="+",
+        choices=list(RESOURCES),
+        default=["heart"])
+    parser.add_argument(
+        "--detail_level",
+        help="Intraday detail level",
+        choices=["1sec", "1min", "15min"],
+        default="1min")
+    parser.add_argument(
+        "--credentials",
+        help="File with the app's client id and secret",
+        default="/Users/kmcmanus/Documents/classes/digitalhealth_project/data/keys/fitbit_credentials.txt")
+    parser.add_argument(
+        "--tokens",
+        help="File with the tokens saved by authorize_fitbit.py, refreshed tokens are saved back",
+        default="/Users/kmcmanus/Documents/classes/digitalhealth_project/data/keys/temp_creds.txt")
+    parser.add_argument(
+        "--out_dir",
+        help="Job directory, for the partitions and checkpoint",
+        required=True)
+    parser.add_argument(
+        "--cache",
+        help="SQLite file to cache responses in",
+        default=None)
+    parser.add_argument(
+        "--api_endpoint",
+        help="API to fetch from instead of api.fitbit.com, e.g. a local mock. "
+             "Plain http is allowed for it",
+        default=None)
+    args = parser.parse_args()
+
+    client = Fitbit(refresh_cb=save_tokens(args.tokens), cache=args.cache,
+                    **read_credentials(args.credentials, args.tokens))
+    if args.api_endpoint:
+        use_api_endpoint(client, args.api_endpoint)
+    job = ExtractionJob(client, args.out_dir, args.resources,
+                        pd.date_range(start=args.start, end=args.end), args.detail_level)
+    print("Fetched {} partitions (resource days)".format(job.run()))
+    for resource in args.resources:
+        df = job.combine(resource)
+        if df is None:
+            print("No {} data from {} to {}, nothing written".format(
+                resource, args.start, args.end))
+            continue
+        out_fn = os.path.join(args.out_dir, "{}_{}_{}_{}.csv".format(
+            resource, args.start.replace('-', ''), args.end.replace('-', ''), args.detail_level))
+        df.to_csv(out_fn)
+        print("Wrote {}".format(out_fn))
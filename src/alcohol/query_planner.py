@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Plans the fewest Fitbit API calls for "resource from start to end at a
+granularity" queries, runs them, and returns one tidy frame.
+
+Daily time series accept a date range of up to a per-resource maximum, so a
+range is split into as few of those as possible instead of a call per day.
+Intraday series are one day per call. Overlapping or adjacent queries for
+the same resource and granularity are merged first, so no day is fetched
+twice.
+
+    queries = [Query('activities/heart', '2021-03-08', '2021-06-09', '1d'),
+               Query('activities/steps', '2021-03-08', '2021-06-09', '1d')]
+    df = fetch(client, queries)   # 2 calls rather than 188
+
+https://dev.fitbit.com/build/reference/web-api/activity-timeseries/
+"""
+import datetime
+from collections import namedtuple
+
+import pandas as pd
+
+from decoding import intraday_arrays
+
+# granularity is '1d' for daily values, or an intraday detail level
+Query = namedtuple('Query', ['resource', 'start', 'end', 'granularity'])
+Call = namedtuple('Call', ['resource', 'start', 'end', 'granularity'])
+
+DAILY = '1d'
+INTRADAY = ('1sec', '1min', '15min')
+
+# Most days a daily time series call can cover
+MAX_DAYS = {
+    'activities/steps': 1095,
+    'activities/distance': 1095,
+    'activities/calories': 1095,
+    'activities/floors': 1095,
+    'activities/minutesSedentary': 1095,
+    'activities/heart': 365,
+    'body/weight': 1095,
+    'body/fat': 1095,
+    'body/bmi': 1095,
+    'foods/log/water': 1095,
+    'foods/log/caloriesIn': 1095,
+    'sleep': 100,
+}
+INTRADAY_RESOURCES = ('activities/heart', 'activities/steps', 'activities/distance',
+                      'activities/calories', 'activities/floors')
+
+COLUMNS = ['resource', 'granularity', 'time', 'value']
+
+
+def _day(date):
+    return pd.Timestamp(date).normalize()
+
+
+def merge_queries(queries):
+    """
+    Queries with overlapping or adjacent days merged, per resource and
+    granularity. Raises ValueError for a granularity a resource doesn't have.
+    """
+    ranges = {}
+    for query in queries:
+        if query.granularity == DAILY:
+            if query.resource not in MAX_DAYS:
+                raise ValueError("No daily time series for {}, use one of {}".format(
+                    query.resource, ', '.join(MAX_DAYS)))
+        elif query.granularity not in INTRADAY:
+            raise ValueError("Granularity must be {} or one of {}".format(
+                DAILY, ', '.join(INTRADAY)))
+        elif query.resource not in INTRADAY_RESOURCES:
+            raise ValueError("No intraday time series for {}".format(query.resource))
+        start, end = _day(query.start), _day(query.end)
+        if end < start:
+            raise ValueError("Query ends before it starts: {}".format(query))
+        ranges.setdefault((query.resource, query.granularity), []).append((start, end))
+
+    merged = []
+    one_day = datetime.timedelta(days=1)
+    for (resource, granularity), spans in ranges.items():
+        spans.sort()
+        start, end = spans[0]
+        for next_start, next_end in spans[1:]:
+            if next_start <= end + one_day:
+                end = max(end, next_end)
+            else:
+                merged.append(Query(resource, start, end, granularity))
+                start, end = next_start, next_end
+        merged.append(Query(resource, start, end, granularity))
+    return merged
+
+
+def plan(queries):
+    """ The calls that cover queries, fewest first by merging then splitting """
+    calls = []
+    for query in merge_queries(queries):
+        max_days = MAX_DAYS[query.resource] if query.granularity == DAILY else 1
+        start = query.start
+        while start <= query.end:
+            end = min(query.end, start + datetime.timedelta(days=max_days - 1))
+            calls.append(Call(query.resource, start, end, query.granularity))
+            start = end + datetime.timedelta(days=1)
+    return calls
+
+
+def _daily_frame(result, resource):
+    if resource == 'sleep':
+        # One row per sleep log, a night can have naps too
+        logs = result['sleep']
+        return pd.DataFrame({'time': [log['dateOfSleep'] for log in logs],
+                             'value': [log['minutesAsleep'] for log in logs]})
+    rows = result[resource.replace('/', '-')]
+    values = [row['value'] for row in rows]
+    if resource == 'activities/heart':
+        # Days without a resting heart rate become NaN
+        values = [value.get('restingHeartRate') for value in values]
+    return pd.DataFrame({'time': [row['dateTime'] for row in rows], 'value': values})
+
+
+def _intraday_frame(result, resource, date):
+    times, values = intraday_arrays(result, resource)
+    return pd.DataFrame({'time': date + pd.to_timedelta(times, unit='s'), 'value': values})
+
+
+def run(client, calls):
+    """
+    Makes calls with client (Fitbit, or anything with its time_series and
+    intraday_time_series) and returns the tidy frame of their results
+    """
+    frames = []
+    for call in calls:
+        if call.granularity == DAILY:
+            result = client.time_series(call.resource, base_date=call.start, end_date=call.end)
+            df = _daily_frame(result, call.resource)
+        else:
+            result = client.intraday_time_series(call.resource, base_date=call.start,
+                                                 detail_level=call.granularity)
+            df = _intraday_frame(result, call.resource, call.start)
+        df['resource'] = call.resource
+        df['granularity'] = call.granularity
+        frames.append(df)
+    if not frames:
+        return pd.DataFrame({'resource': pd.Categorical([]), 'granularity': pd.Categorical([]),
+                             'time': pd.to_datetime([]), 'value': pd.Series([], dtype=float)})
+
+    df = pd.concat(frames, ignore_index=True)[COLUMNS]
+    df['resource'] = df['resource'].astype('category')
+    df['granularity'] = df['granularity'].astype('category')
+    df['time'] = pd.to_datetime(df['time'])
+    df['value'] = pd.to_numeric(df['value'], errors='coerce').astype(float)
+    return df.sort_values(COLUMNS[:3], ignore_index=True)
+
+
+def fetch(client, queries):
+    """ plan() then run(): one tidy frame with a row per resource, granularity and time """
+    return run(client, plan(queries))
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent SQLite cache of Fitbit GET responses, keyed by URL.
+
+Data for a day that was over when it was fetched can't change (as long as
+the tracker had synced), so responses whose dates are all before the day
+they were fetched on never expire. Anything else ("today", the current day,
+or URLs without dates such as the profile) is kept for `ttl` seconds.
+Re-running an extraction after a crash then costs no API quota for the
+days it already fetched.
+"""
+import datetime
+import re
+import sqlite3
+import threading
+import time
+
+DATE_PATTERN = re.compile(r'/(\d{4}-\d{2}-\d{2})(?=[/.])')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    body BLOB NOT NULL,
+    fetched_at REAL NOT NULL,
+    expires_at REAL
+)
+"""
+
+
+class ResponseCache(object):
+    """
+    - path: SQLite file, created if needed (":memory:" for a throwaway cache)
+    - ttl: seconds to keep responses that can still change
+    - namespace: added to every key, e.g. a user id when one cache file is
+      shared by several users' clients (URLs use "-" for the current user)
+    """
+
+    def __init__(self, path, ttl=3600, namespace='', clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.namespace = namespace
+        self.clock = clock
+        self._lock = threading.Lock()
+        # Shared by the threads of AsyncFitbit, the lock serializes access
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        if path != ':memory:':
+            self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(SCHEMA)
+        self._db.commit()
+        self.reset_stats()
+
+    def key(self, url, language=''):
+        """ Cache key of a GET of url, responses depend on the Accept-Language """
+        return '{}|{}|{}'.format(self.namespace, language, url)
+
+    def expires_at(self, url, fetched_at):
+        """ When a response for url fetched at fetched_at expires, None for never """
+        dates = DATE_PATTERN.findall(url)
+        fetched_day = datetime.date.fromtimestamp(fetched_at).isoformat()
+        if dates and 'today' not in url and max(dates) < fetched_day:
+            return None
+        return fetched_at + self.ttl
+
+    def get(self, url, language=''):
+        """ Cached response body for url, or None on a miss """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT body, expires_at FROM responses WHERE key = ?',
+                (self.key(url, language),)).fetchone()
+            if row is None:
+                self._stats['misses'] += 1
+                return None
+            body, expires_at = row
+            if expires_at is not None and expires_at <= self.clock():
+                self._stats['misses'] += 1
+                self._stats['expired'] += 1
+                return None
+            self._stats['hits'] += 1
+            return body
+
+    def put(self, url, body, language=''):
+        """ Store the response body of a successful GET of url """
+        fetched_at = self.clock()
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                (self.key(url, language), body, fetched_at,
+                 self.expires_at(url, fetched_at)))
+            self._db.commit()
+            self._stats['stores'] += 1
+
+    def purge_expired(self):
+        """ Delete expired responses, returns how many there were """
+        with self._lock:
+            deleted = self._db.execute(
+                'DELETE FROM responses WHERE expires_at IS NOT NULL AND expires_at <= ?',
+                (self.clock(),)).rowcount
+            self._db.commit()
+        return deleted
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM responses')
+            self._db.commit()
+
+    def stats(self):
+        """
+        Hits, misses (expired entries count as misses too), stores and
+        hit rate since the cache was opened or reset_stats(), plus the
+        number of immutable and expiring entries on disk
+        """
+        with self._lock:
+            immutable, expiring = self._db.execute(
+                'SELECT COUNT(*) - COUNT(expires_at), COUNT(expires_at) FROM responses'
+            ).fetchone()
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / float(lookups) if lookups else 0.0
+        stats['immutable_entries'] = immutable
+        stats['expiring_entries'] = expiring
+        return stats
+
+    def reset_stats(self):
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'stores': 0}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
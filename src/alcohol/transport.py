@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP transport for FitbitOauth2Client: a pooled keep-alive connection
+adapter, retries with jittered exponential backoff, and pacing by the
+Fitbit-Rate-Limit-* headers so bulk pulls can run as fast as the API allows.
+
+https://dev.fitbit.com/build/reference/web-api/developer-guide/application-design/#Rate-Limits
+"""
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RATE_LIMIT_LIMIT = 'Fitbit-Rate-Limit-Limit'
+RATE_LIMIT_REMAINING = 'Fitbit-Rate-Limit-Remaining'
+RATE_LIMIT_RESET = 'Fitbit-Rate-Limit-Reset'
+
+# Fitbit's rate limit window, in seconds
+WINDOW = 3600
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Server errors and dropped connections are only retried for these, a 429
+# means the request was not processed so it is always safe to retry
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+class RateLimiter(object):
+    """
+    Tracks the hourly request budget Fitbit reports on every response and
+    holds requests back once it is spent, until the window resets.
+        - reserve: requests to leave unused in each window, e.g. for other
+          clients of the same app
+    """
+
+    def __init__(self, reserve=0, clock=time.monotonic, sleep=time.sleep):
+        self.reserve = reserve
+        self.clock = clock
+        self.sleep = sleep
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None
+        # Once the budget is spent, every caller waits until this time
+        self.resume_at = None
+        self._lock = threading.Lock()
+
+    def update(self, response):
+        """ Read the rate limit headers of a response, if it has them """
+        headers = response.headers
+        try:
+            remaining = int(headers[RATE_LIMIT_REMAINING])
+            reset = int(headers[RATE_LIMIT_RESET])
+        except (KeyError, ValueError):
+            return
+        with self._lock:
+            self.remaining = remaining
+            self.reset_at = self.clock() + reset
+            if RATE_LIMIT_LIMIT in headers:
+                self.limit = int(headers[RATE_LIMIT_LIMIT])
+            else:
+                # Without the limit header, the most seen remaining is
+                # the best guess of a full window
+                self.limit = max(self.limit or 0, remaining + 1)
+
+    def acquire(self):
+        """
+        Take one request from the budget, first sleeping until the window
+        resets if it is spent. Without rate limit headers yet, requests
+        are not held back.
+        """
+        while True:
+            with self._lock:
+                now = self.clock()
+                if self.resume_at is not None and now >= self.resume_at:
+                    # Assume a full window after the reset, the next
+                    # response will say how much of it is left
+                    self.remaining = self.limit
+                    self.reset_at = self.resume_at + WINDOW
+                    self.resume_at = None
+                if self.resume_at is None:
+                    if self.remaining is None:
+                        return
+                    if self.remaining > self.reserve:
+                        self.remaining -= 1
+                        return
+                    if self.limit is not None and self.limit <= self.reserve:
+                        raise ValueError("A reserve of {} leaves none of the {} requests "
+                                         "an hour".format(self.reserve, self.limit))
+                    self.resume_at = self.reset_at
+                wait = self.resume_at - now
+            if wait > 0:
+                self.sleep(wait)
+
+
+class RetryPolicy(object):
+    """
+    When and how long to wait before retrying a request. Waits grow
+    exponentially with "full jitter" (uniform between 0 and the cap) so
+    parallel clients don't retry in lockstep, and a Retry-After header
+    from the server takes precedence.
+    """
+
+    def __init__(self, max_retries=5, backoff_factor=1.0, max_backoff=120.0,
+                 statuses=RETRY_STATUSES, rng=random):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.statuses = statuses
+        self.rng = rng
+
+    def should_retry(self, attempt, method, response=None):
+        """ Whether to retry after a response (or, if None, a connection error) """
+        if attempt >= self.max_retries:
+            return False
+        if response is None:
+            return method.upper() in IDEMPOTENT_METHODS
+        if response.status_code == 429:
+            return True
+        return (response.status_code in self.statuses and
+                method.upper() in IDEMPOTENT_METHODS)
+
+    def delay(self, attempt, response=None):
+        """ Seconds to wait before retry number attempt + 1 """
+        if response is not None and 'Retry-After' in response.headers:
+            try:
+                return min(float(response.headers['Retry-After']), self.max_backoff)
+            except ValueError:
+                pass
+        cap = min(self.max_backoff, self.backoff_factor * 2 ** attempt)
+        return self.rng.uniform(0, cap)
+
+
+class Transport(object):
+    """
+    Sends a requests session's requests through a sized connection pool,
+    retrying and pacing them.
+        - session: requests.Session (or OAuth2Session) to send with
+        - pool_connections, pool_maxsize: hosts to keep pools for, and
+          keep-alive connections per host. Size the pool to the number of
+          threads sharing the session.
+        - retry: RetryPolicy, the defaults if None
+        - rate_limiter: RateLimiter, the defaults if None
+    """
+
+    def __init__(self, session, pool_connections=4, pool_maxsize=10, retry=None,
+                 rate_limiter=None, sleep=time.sleep):
+        self.session = session
+        self.retry = retry or RetryPolicy()
+        self.rate_limiter = rate_limiter or RateLimiter(sleep=sleep)
+        self.sleep = sleep
+        # Retries are done here rather than by urllib3 so that they go
+        # through the rate limiter and honor Retry-After
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize, pool_block=True,
+                              max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        self.stats = {'requests': 0, 'retries': 0}
+
+    def request(self, method, url, **kwargs):
+        """ session.request with retries, returns the final response """
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            self.stats['requests'] += 1
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if not self.retry.should_retry(attempt, method):
+                    raise
+                response = None
+            else:
+                self.rate_limiter.update(response)
+                if not self.retry.should_retry(attempt, method, response):
+                    return response
+            self.sleep(self.retry.delay(attempt, response))
+            self.stats['retries'] += 1
+            attempt += 1
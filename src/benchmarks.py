@@ -0,0 +1,272 @@
+""" Timing benchmarks for the analysis code
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Cold start budgets, in seconds, for `python -m digitalhealth --help` and
+# for `python -m digitalhealth <command> --help`
+# (about 0.1s each, Python itself takes most of that)
+DISPATCH_BUDGET = 0.25
+COMMAND_BUDGET = 0.3
+# Modules reported as loaded by each startup, none of them is needed for --help
+HEAVY_MODULES = ["numpy", "pandas", "pyarrow", "numba", "tensorflow", "tensorflow_probability"]
+FORBIDDEN_AT_STARTUP = HEAVY_MODULES
+
+STARTUP_CODE = """
+import sys
+sys.argv = ["digitalhealth"] + {argv!r}
+import digitalhealth
+try:
+    digitalhealth.main()
+except SystemExit:
+    pass
+print("loaded:", *[name for name in {heavy!r} if name in sys.modules])
+"""
+
+
+def time_import(modules):
+    """ Seconds to import modules in a fresh interpreter, None if it fails """
+    code = "import {}".format(", ".join(modules))
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, cwd=SRC_DIR)
+    elapsed = time.perf_counter() - start
+    return elapsed if result.returncode == 0 else None
+
+
+def time_startup(argv, repeats=3):
+    """ Best wall time of `python -m digitalhealth argv` in a fresh
+        interpreter, and the HEAVY_MODULES it loaded
+    """
+    code = STARTUP_CODE.format(argv=list(argv), heavy=HEAVY_MODULES)
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True,
+                                text=True, cwd=SRC_DIR)
+        best = min(best, time.perf_counter() - start)
+    loaded = result.stdout.rsplit("loaded:", 1)[-1].split()
+    return best, loaded
+
+
+def time_call(func, repeats=3):
+    """ Best wall time of func() over repeats calls, and its last result """
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def simulate_heart_rate(num_steps, seed=0):
+    """ Heart rate like observations from a 2 state Gaussian HMM """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    transition = np.array([[0.97, 0.03], [0.05, 0.95]])
+    states = np.empty(num_steps, dtype=np.int64)
+    states[0] = 0
+    switches = rng.uniform(size=num_steps)
+    for t in range(1, num_steps):
+        states[t] = states[t - 1] ^ (switches[t] > transition[states[t - 1], states[t - 1]])
+    return np.where(states == 0, rng.normal(60, 4, num_steps), rng.normal(82, 7, num_steps))
+
+
+def _report(name, seconds):
+    if seconds is None:
+        print("{:<40} not available".format(name))
+    else:
+        print("{:<40} {:8.3f}s".format(name, seconds))
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command("hmm")
+@click.option("--in_file", default=None,
+              help="Formatted heart rate file (from format_data.py), simulated data if not given")
+@click.option("--num_steps", default=20160, help="Observations to fit")
+@click.option("--repeats", default=3, help="Fits to time per engine, the best is reported")
+@click.option("--restarts", default=20, help="Random starts for the restart benchmark")
+def benchmark_hmm(in_file, num_steps, repeats, restarts):
+    """ Import and fit time of hmm.py against the TensorFlow stack """
+    import numpy as np
+
+    import hmm
+    from storage import read_frame
+
+    if in_file is None:
+        observations = simulate_heart_rate(num_steps)
+    else:
+        bpm = read_frame(in_file, columns=["bpm"])["bpm"].dropna()
+        observations = bpm.to_numpy(dtype=np.float64)[:num_steps]
+    print("Fitting {} observations".format(len(observations)))
+
+    _report("import hmm", time_import(["hmm"]))
+    _report("import tensorflow, tensorflow_probability",
+            time_import(["tensorflow", "tensorflow_probability"]))
+
+    start = hmm.random_start(np.random.default_rng(0))
+    engines = ["numpy"] + (["numba"] if hmm.HAS_NUMBA else [])
+    for engine in engines:
+        # Compile (or load the numba cache) outside the timed fits
+        hmm.forward_backward(observations[:10], start, engine=engine)
+        seconds, (_, history) = time_call(
+            lambda: hmm.baum_welch(observations, start, engine=engine), repeats)
+        _report("fit {} ({} EM steps)".format(engine, len(history)), seconds)
+
+        rng = np.random.default_rng(0)
+        starts = [hmm.random_start(rng) for _ in range(restarts)]
+        seconds, _ = time_call(lambda: [hmm.baum_welch(observations, params, engine=engine)
+                                        for params in starts], 1)
+        _report("{} restarts {} one by one".format(restarts, engine), seconds)
+        seconds, _ = time_call(lambda: hmm.fit_restarts(observations, starts, engine=engine), 1)
+        _report("{} restarts {} batched".format(restarts, engine), seconds)
+
+    _report("fit tensorflow", time_tensorflow_fit(observations, repeats))
+
+
+def time_tensorflow_fit(observations, repeats):
+    """ Fit time of optimize_hmm_parameters.py's TensorFlow engine, None
+        when TensorFlow or its BaumWelch class can't be imported
+    """
+    try:
+        import tensorflow as tf
+        import optimize_hmm_parameters
+        with tempfile.TemporaryDirectory() as out_dir:
+            args = argparse.Namespace(out_dir=out_dir)
+            tf_observations = tf.constant(observations, dtype=tf.float32)
+            seconds, _ = time_call(lambda: optimize_hmm_parameters.run_random_start_tf(
+                args, tf_observations), repeats)
+    except ImportError:
+        return None
+    return seconds
+
+
+@main.command("decode")
+@click.option("--in_file", required=True, help="Formatted heart rate file (from format_data.py)")
+@click.option("--params_file", default=None,
+              help="HMM parameters (from optimize_hmm_parameters.py), fit on in_file if not given")
+@click.option("--repeats", default=3, help="Decodes to time per method, the best is reported")
+def benchmark_decode(in_file, params_file, repeats):
+    """ Sleep state decoding throughput, in minutes decoded per second """
+    import numpy as np
+
+    import decode_sleep_states
+    import hmm
+    from storage import read_frame
+
+    df = read_frame(in_file, columns=["bpm"])
+    if params_file is None:
+        observations = df["bpm"].dropna().to_numpy(dtype=np.float64)
+        params, _ = hmm.baum_welch(observations, hmm.random_start(np.random.default_rng(0)))
+    else:
+        params = decode_sleep_states.load_params(params_file)
+    num_nights = len(decode_sleep_states.night_segments(df.index)[0])
+    print("Decoding {} minutes in {} nights".format(len(df), num_nights))
+
+    for method in decode_sleep_states.METHODS:
+        seconds, _ = time_call(lambda: decode_sleep_states.decode_frame(
+            df.copy(), params, method=method), repeats)
+        print("{:<40} {:8.3f}s {:12,.0f} minutes/s".format(method, seconds, len(df) / seconds))
+
+
+def write_o2ring_csv(fn, num_rows, seed=0):
+    """ Write a simulated O2Ring export, with some blank Time and SpO2 cells """
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    times = pd.date_range("2020-06-28 23:00:00", periods=num_rows, freq="4s")
+    df = pd.DataFrame({
+        "Time": times.strftime("%H:%M:%S %b %d %Y"),
+        "SpO2(%)": rng.integers(85, 100, num_rows).astype(str),
+        "Pulse Rate(bpm)": rng.integers(45, 90, num_rows),
+        "Motion": rng.integers(0, 5, num_rows),
+        "Vibration": 0,
+    })
+    df.loc[rng.random(num_rows) < 0.01, "Time"] = ""
+    df.loc[rng.random(num_rows) < 0.01, "SpO2(%)"] = ""
+    df.to_csv(fn, index=False)
+
+
+@main.command("read-csv")
+@click.option("--in_file", default=None,
+              help="O2Ring export to read, simulated (with blank cells) if not given")
+@click.option("--num_rows", default=500000, help="Rows of the simulated file")
+@click.option("--repeats", default=3, help="Reads to time per engine, the best is reported")
+def benchmark_read_csv(in_file, num_rows, repeats):
+    """ Time of typed_csv's pyarrow and pandas readers, exits with 1 if
+        they don't return identical columns
+    """
+    import warnings
+
+    import numpy as np
+
+    import typed_csv
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if in_file is None:
+            in_file = os.path.join(tmp_dir, "o2ring.csv")
+            write_o2ring_csv(in_file, num_rows)
+        frames = {}
+        for engine in typed_csv.ITER_CHUNKS:
+            if engine == "pyarrow" and typed_csv.pa is None:
+                _report(engine, None)
+                continue
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                seconds, frames[engine] = time_call(lambda: typed_csv.read_typed_csv(
+                    [in_file], "o2ring", engine=engine), repeats)
+            _report("{} ({} rows)".format(engine, len(frames[engine])), seconds)
+
+    if len(frames) == 2:
+        same = all(np.array_equal(frames["pyarrow"][name].to_numpy(),
+                                  frames["pandas"][name].to_numpy())
+                   for name in typed_csv.SCHEMAS["o2ring"]["columns"])
+        print("pyarrow and pandas agree: {}".format("yes" if same else "NO"))
+        if not same:
+            sys.exit(1)
+
+
+@main.command("imports")
+@click.option("--repeats", default=3, help="Cold starts to time per command, the best is reported")
+@click.option("--dispatch_budget", default=DISPATCH_BUDGET,
+              help="Seconds allowed for `digitalhealth --help`")
+@click.option("--command_budget", default=COMMAND_BUDGET,
+              help="Seconds allowed for `digitalhealth <command> --help`")
+def benchmark_imports(repeats, dispatch_budget, command_budget):
+    """ Cold start time of the digitalhealth commands, exits with 1 if
+        any is over budget or imports numpy, pandas or any other heavy
+        module just for --help
+    """
+    import digitalhealth
+
+    _report("python", time_import(["sys"]))
+    checks = [([], dispatch_budget)] + [([name], command_budget)
+                                        for name in digitalhealth.COMMANDS]
+    failed = False
+    for argv, budget in checks:
+        seconds, loaded = time_startup(argv + ["--help"], repeats)
+        over = seconds > budget or any(name in loaded for name in FORBIDDEN_AT_STARTUP)
+        failed |= over
+        print("{:<40} {:8.3f}s budget {:.2f}s {:<5} loaded: {}".format(
+            " ".join(["digitalhealth"] + argv + ["--help"]), seconds, budget,
+            "OVER" if over else "ok", ", ".join(loaded) or "-"))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
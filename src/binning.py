@@ -0,0 +1,42 @@
+""" Assign values to declared bins in one vectorized pass.
+
+A bin spec is a dict with
+    edges: increasing bin edges, bins are (edges[i], edges[i + 1]]
+    labels: one label per bin
+    fill (optional): label for values outside every bin (and NaN). If
+        given the result is a compact integer array, otherwise it is a
+        categorical with missing values for those.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def digitize(values, edges, labels, fill=None, dtype=np.int8):
+    """ Label each value with the bin (edges[i], edges[i + 1]] it falls in
+        Arguments:
+            values: array-like of numbers
+            edges: increasing bin edges, one more than labels
+            labels: label of each bin
+            fill: label for values outside the bins, see module docstring
+            dtype: dtype of the result when fill is given
+        Returns: np.ndarray if fill is given, otherwise pd.Categorical
+    """
+    if len(edges) != len(labels) + 1:
+        raise ValueError("Need exactly one more edge than labels")
+    values = np.asarray(values, dtype=np.float64)
+    # np.digitize puts NaN past the last edge, so it falls outside every bin
+    codes = np.digitize(values, edges, right=True) - 1
+    outside = (codes < 0) | (codes >= len(labels))
+    codes[outside] = -1
+
+    if fill is None:
+        return pd.Categorical.from_codes(codes, categories=list(labels))
+    lookup = np.append(np.asarray(labels, dtype=dtype), np.asarray(fill, dtype=dtype))
+    # -1 indexes the fill value at the end of lookup
+    return lookup[codes]
+
+
+def bin_column(values, spec):
+    """ Bin values (array-like or Series) with a bin spec, see module docstring """
+    return digitize(values, spec["edges"], spec["labels"], fill=spec.get("fill"))
@@ -0,0 +1,209 @@
+""" Memory-mapped, one-file-per-column cache of a time indexed dataframe.
+
+A cache is a directory holding one .npy file per column, the index (a
+DatetimeIndex as datetime64[ns], or a numeric index) in __index__.npy and a
+small schema.json describing how to rebuild the index and each column.
+Opening a cache only reads the schema; column data is memory mapped, so
+only the rows and columns that are touched are paged in.
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+SCHEMA_FILE = "schema.json"
+INDEX_FILE = "__index__.npy"
+NIGHT_COLUMN = "sleep_night"
+SCHEMA_VERSION = 2
+
+
+def is_column_cache(path):
+    """ True if path is a directory written by write_column_cache """
+    return os.path.isfile(os.path.join(path, SCHEMA_FILE))
+
+
+def _column_file(i):
+    return "col_{:03d}.npy".format(i)
+
+
+def night_key(night):
+    """ The "YYYY-MM-DD" key of a sleep night, from a date, Timestamp or string """
+    return pd.Timestamp(night).strftime("%Y-%m-%d")
+
+
+def _night_ranges(df):
+    """ Returns {night: [first row, last row + 1]} for a time sorted df """
+    if NIGHT_COLUMN not in df.columns:
+        return {}
+    codes, uniques = pd.factorize(df[NIGHT_COLUMN])
+    starts = np.flatnonzero(np.diff(codes, prepend=-2))
+    stops = np.append(starts[1:], len(codes))
+    return {night_key(uniques[codes[start]]): [int(start), int(stop)]
+            for start, stop in zip(starts, stops) if codes[start] >= 0}
+
+
+def _numeric_objects(values):
+    """ Returns an object column holding only numbers as a numeric column """
+    if values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) in (
+            "integer", "floating", "mixed-integer-float", "decimal"):
+        return pd.to_numeric(values)
+    return values
+
+
+def write_column_cache(df, cache_dir):
+    """ Write df as a column cache
+        Arguments:
+            df: dataframe with a DatetimeIndex sorted by time, or a numeric
+                index (e.g. the episodes table)
+            cache_dir: directory to write, replacing any existing cache
+        Returns: None
+    """
+    if isinstance(df.index, pd.DatetimeIndex):
+        index = np.asarray(df.index.values, dtype="datetime64[ns]")
+        index_kind = "datetime"
+    elif df.index.dtype.kind in "biuf":
+        index = df.index.to_numpy()
+        index_kind = "plain"
+    else:
+        raise ValueError("A column cache needs a DatetimeIndex or a numeric index, "
+                         "not {}".format(df.index.dtype))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # Remove the schema first so a half written cache is never read
+    if is_column_cache(cache_dir):
+        os.remove(os.path.join(cache_dir, SCHEMA_FILE))
+
+    np.save(os.path.join(cache_dir, INDEX_FILE), index)
+
+    columns = []
+    for i, name in enumerate(df.columns):
+        values = _numeric_objects(df[name])
+        column = {"name": name, "file": _column_file(i)}
+        if isinstance(values.dtype, np.dtype) and values.dtype.kind in "biufmM":
+            data = values.to_numpy()
+            column["kind"] = "plain"
+        else:
+            # Store codes, and the categories as strings in the schema
+            codes, uniques = pd.factorize(values)
+            data = codes.astype(np.int32)
+            column["kind"] = "categorical"
+            column["categories"] = [str(x) for x in uniques]
+            categories = pd.Index(np.asarray(uniques, dtype=object).tolist())
+            if categories.dtype.kind in "biufM":
+                # Numbers and times are restored from their strings
+                column["categories_dtype"] = str(categories.dtype)
+        np.save(os.path.join(cache_dir, column["file"]), data)
+        columns.append(column)
+
+    schema = {
+        "version": SCHEMA_VERSION,
+        "n_rows": len(df),
+        "index_name": df.index.name,
+        "index_kind": index_kind,
+        "columns": columns,
+        "nights": _night_ranges(df),
+    }
+    with open(os.path.join(cache_dir, SCHEMA_FILE), "w") as f:
+        json.dump(schema, f, indent=1)
+
+
+class ColumnCache(object):
+    """ Zero-copy reader for a directory written by write_column_cache """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, SCHEMA_FILE)) as f:
+            self.schema = json.load(f)
+        self._columns = {x["name"]: x for x in self.schema["columns"]}
+        self.index = np.load(os.path.join(cache_dir, INDEX_FILE), mmap_mode="r")
+        # Caches written before the keys were normalised used str(Timestamp)
+        self._nights = {night_key(k): tuple(v) for k, v in self.schema["nights"].items()}
+
+    @property
+    def columns(self):
+        return [x["name"] for x in self.schema["columns"]]
+
+    @property
+    def nights(self):
+        """ {night: (first row, last row + 1)} """
+        return dict(self._nights)
+
+    def __len__(self):
+        return self.schema["n_rows"]
+
+    def column(self, name):
+        """ Returns the memory mapped values of a column, without copying """
+        return np.load(os.path.join(self.cache_dir, self._columns[name]["file"]),
+                       mmap_mode="r")
+
+    def rows_for_nights(self, nights):
+        """ Returns the row positions covered by a list of nights
+            (dates, Timestamps or "YYYY-MM-DD" strings)
+        """
+        ranges = []
+        for night in nights:
+            key = night_key(night)
+            if key not in self._nights:
+                raise KeyError("No sleep night {} in {}".format(key, self.cache_dir))
+            ranges.append(self._nights[key])
+        if not ranges:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(start, stop) for start, stop in ranges])
+
+    def rows_for_dates(self, dates):
+        """ Returns the row positions on a list of calendar dates """
+        if self.schema.get("index_kind", "datetime") != "datetime":
+            raise ValueError("{} doesn't have a DatetimeIndex".format(self.cache_dir))
+        dates = np.asarray(pd.to_datetime(dates).values, dtype="datetime64[D]")
+        starts = np.searchsorted(self.index, dates.astype("datetime64[ns]"))
+        stops = np.searchsorted(self.index, (dates + 1).astype("datetime64[ns]"))
+        if not len(starts):
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(start, stop)
+                               for start, stop in zip(starts, stops)])
+
+    def _select(self, values, rows):
+        if rows is None:
+            return values
+        if len(rows) and np.all(np.diff(rows) == 1):
+            # Contiguous rows are a view into the map
+            return values[rows[0]:rows[-1] + 1]
+        return values[rows]
+
+    def load(self, columns=None, nights=None, dates=None, copy=False):
+        """ Build a dataframe from the cache
+            Arguments:
+                columns: optional list of columns to load
+                nights: optional list of sleep nights to load
+                dates: optional list of calendar dates to load
+                copy: if False, numeric columns stay backed by the memory map
+            Returns: dataframe with the index it was written with
+        """
+        rows = None
+        if nights is not None:
+            rows = self.rows_for_nights(nights)
+        if dates is not None:
+            date_rows = self.rows_for_dates(dates)
+            rows = date_rows if rows is None else np.intersect1d(rows, date_rows)
+
+        data = {}
+        for name in (self.columns if columns is None else columns):
+            values = self._select(self.column(name), rows)
+            spec = self._columns[name]
+            if spec["kind"] == "categorical":
+                categories = pd.Index(spec["categories"])
+                if "categories_dtype" in spec:
+                    categories = categories.astype(spec["categories_dtype"])
+                values = pd.Categorical.from_codes(np.asarray(values),
+                                                   categories=categories)
+            elif copy:
+                values = np.array(values)
+            data[name] = values
+        index = self._select(self.index, rows)
+        if self.schema.get("index_kind", "datetime") == "datetime":
+            index = pd.DatetimeIndex(index, name=self.schema["index_name"])
+        else:
+            index = pd.Index(index, name=self.schema["index_name"])
+        return pd.DataFrame(data, index=index, copy=False)
@@ -0,0 +1,148 @@
+'''
+Labels heart rate data formatted in format_data.py with the sleep states
+of an HMM fit by optimize_hmm_parameters.py
+'''
+
+import json
+import argparse
+
+# numpy and hmm are imported by the functions that need them, so --help
+# doesn't wait for them
+from recording import NIGHT_CUTOFF, parse_night_cutoff, sleep_night_days
+from storage import read_frame, write_frame
+
+METHODS = ["viterbi", "posterior"]
+
+# Same coding as fb_sleep, where wake is 1 and the sleep stages are <= 0
+WAKE = 1
+ASLEEP = 0
+
+
+def load_params(fn):
+    '''
+    Reads HMM parameters saved by optimize_hmm_parameters.py
+
+            Parameters:
+                    fn (str): JSON file with the best fit under "best", or
+                        just the parameters
+
+            Returns:
+                    params (hmm.HMMParams)
+    '''
+    import hmm
+
+    with open(fn) as f:
+        values = json.load(f)
+    return hmm.params_from_dict(values.get("best", values))
+
+
+def night_segments(index, cutoff=NIGHT_CUTOFF):
+    '''
+    Splits a sorted DatetimeIndex into its sleep nights
+
+            Returns:
+                    starts, stops (np.ndarray): row bounds of each night
+    '''
+    import numpy as np
+
+    days = sleep_night_days(index, cutoff)
+    breaks = np.flatnonzero(np.diff(days)) + 1
+    return np.append(0, breaks), np.append(breaks, len(days))
+
+
+def decode_frame(df, params, method="viterbi", cutoff=NIGHT_CUTOFF):
+    '''
+    Decodes the sleep state of every minute, one night per batch row
+
+            Parameters:
+                    df (pd.DataFrame): time sorted data with a bpm column,
+                        minutes without a reading are decoded from the
+                        minutes around them
+                    params (hmm.HMMParams): fitted 2 state model, the state
+                        with the lower mean heart rate is sleep
+                    method (str): viterbi for the most likely path, or
+                        posterior for the most likely state of each minute
+                    cutoff (str): "HH:MM" time of day that nights start at
+
+            Returns:
+                    df (pd.DataFrame): with hmm_sleep (coded like fb_sleep)
+                        and hmm_sleep_prob (posterior method only) added
+    '''
+    import numpy as np
+
+    import hmm
+
+    rows, mask = hmm.pad_segments(df["bpm"].to_numpy(dtype=np.float64),
+                                  *night_segments(df.index, cutoff))
+    sleep_state = int(np.argmin(params.means))
+    if method == "viterbi":
+        states = hmm.viterbi(rows, params)[mask]
+    elif method == "posterior":
+        posteriors = hmm.posterior_decode(rows, params)[mask]
+        states = posteriors.argmax(axis=1)
+        df["hmm_sleep_prob"] = posteriors[:, sleep_state]
+    else:
+        raise ValueError("Unknown method {}, expected one of {}".format(method, METHODS))
+    df["hmm_sleep"] = np.where(states == sleep_state, ASLEEP, WAKE).astype(np.int8)
+    return df
+
+
+def main(args):
+    import numpy as np
+
+    params = load_params(args.params_file)
+    df = read_frame(args.in_file)
+    print("Num rows: {}".format(df.shape[0]))
+    df = decode_frame(df, params, method=args.method, cutoff=args.night_cutoff)
+
+    if "fb_sleep" in df:
+        agreement = np.mean((df["fb_sleep"] < WAKE) == (df["hmm_sleep"] < WAKE))
+        print("Minutes where the HMM agrees with fb_sleep on asleep/awake: {:.1%}".format(
+            agreement))
+    write_frame(df, args.out_file)
+
+
+def night_cutoff(value):
+    ''' argparse type of --night_cutoff, a usage error if it isn't a time of day '''
+    try:
+        parse_night_cutoff(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return value
+
+
+def build_parser(prog=None):
+    ''' Command line arguments, also used by the digitalhealth.py subcommand '''
+    parser = argparse.ArgumentParser(prog=prog, description=__doc__)
+    parser.add_argument(
+        "--in_file",
+        help="Heart rate data formatted by format_data.py",
+        default="/Users/kmcmanus/Documents/classes/digitalhealth_project/data/formatted_data/20200308_hr_sleep_1min_first.csv")
+    parser.add_argument(
+        "--params_file",
+        help="HMM parameters, e.g. hmm_restarts.json from optimize_hmm_parameters.py",
+        default="/Users/kmcmanus/Documents/classes/digitalhealth_project/data/hmm_tf_logs/hmm_restarts.json")
+    parser.add_argument(
+        "--out_file",
+        help="Outfile name, the extension (.csv, .parquet or .feather) sets the format",
+        default="/Users/kmcmanus/Documents/classes/digitalhealth_project/data/formatted_data/20200308_hr_sleep_1min_hmm.csv")
+    parser.add_argument(
+        "--method",
+        help="Most likely path (viterbi) or most likely state of each minute (posterior)",
+        choices=METHODS,
+        default="viterbi")
+    parser.add_argument(
+        "--night_cutoff",
+        help="Time of day (HH:MM or HH:MM:SS) that nights start at",
+        type=night_cutoff,
+        default=NIGHT_CUTOFF)
+    return parser
+
+
+def cli(argv=None, prog=None):
+    args = build_parser(prog).parse_args(argv)
+    main(args)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,64 @@
+'''
+Single entry point for the command line scripts:
+
+    python -m digitalhealth <command> [options]
+
+A command's module, and with it pandas, numpy or TensorFlow, is only
+imported once the command has been chosen. Listing the commands is quick
+and each command only pays for its own imports.
+'''
+
+import argparse
+import importlib
+import sys
+
+# Command name: (module, entry point taking (argv, prog), description).
+# Entry points are the argparse scripts' cli functions and the click
+# scripts' commands.
+COMMANDS = {
+    "format-data": (
+        "format_data", "cli",
+        "Convert raw Fitbit exports to one row of heart rate per minute"),
+    "format-sleep-o2": (
+        "format_sleep_o2_data", "main",
+        "Merge sleep position and O2Ring recordings"),
+    "reduce-sleep-o2": (
+        "reduce_sleep_o2_data", "main",
+        "Add position bins and timing columns to the merged sleep data"),
+    "optimize-hmm": (
+        "optimize_hmm_parameters", "cli",
+        "Fit the heart rate HMM with Baum-Welch"),
+    "decode-sleep": (
+        "decode_sleep_states", "cli",
+        "Label heart rate data with the sleep states of a fitted HMM"),
+    "benchmark": (
+        "benchmarks", "main",
+        "Timing benchmarks"),
+}
+
+
+def build_parser():
+    epilog = "commands:\n" + "\n".join(
+        "  {:<18}{}".format(name, description)
+        for name, (_, _, description) in COMMANDS.items())
+    parser = argparse.ArgumentParser(
+        prog="digitalhealth", usage="%(prog)s [-h] command [options]",
+        description=__doc__, epilog=epilog,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=list(COMMANDS), metavar="command",
+                        help="one of the commands below, see <command> --help for its options")
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # Everything after the command belongs to it, including --help
+    split = next((i for i, arg in enumerate(argv) if not arg.startswith("-")), len(argv))
+    args = build_parser().parse_args(argv[:split + 1])
+    module_name, entry, _ = COMMANDS[args.command]
+    module = importlib.import_module(module_name)
+    return getattr(module, entry)(argv[split + 1:], "digitalhealth " + args.command)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+""" Run-length encoding of the sleep grid into episode tables.
+
+A position episode is a run of consecutive rows with the same orient_bin
+within one sleep night, with no gap in the grid. The grid only holds
+buckets with data, so a step longer than one bucket ends the run. Each
+episode keeps what the analyses need (when it started and ended, its
+position, how long it lasted, the lowest SpO2 and the ODI/low oxygen
+activity in it), so per night and per position summaries can be answered
+from a table with one row per episode instead of one row per bucket.
+"""
+
+import numpy as np
+import pandas as pd
+
+EPISODE_COLUMNS = [
+    "start", "end", "sleep_night", "orient_bin", "n_samples", "duration",
+    "min_spo2", "odi_samples", "odi_events", "low_oxygen_samples",
+]
+
+
+def column_codes(values):
+    """ Integer codes of a column, -1 where it is missing """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy()
+    return pd.factorize(values, sort=True)[0]
+
+
+def run_starts(codes, *breaks):
+    """ Mark the first row of each run of equal codes
+        Every row with a missing (negative) code is a run of its own.
+        Arguments:
+            codes: integer codes of the series to encode
+            breaks: more code arrays, a change in any of them also starts a run
+        Returns: boolean array, True where a run starts
+    """
+    starts = np.ones(len(codes), dtype=bool)
+    starts[1:] = codes[1:] != codes[:-1]
+    for other in breaks:
+        starts[1:] |= other[1:] != other[:-1]
+    starts |= codes < 0
+    return starts
+
+
+def infer_bucket_seconds(times):
+    """ Width of the buckets of a sleep grid
+        The grid only holds buckets with data, so its smallest step is one
+        bucket. The median step is several buckets when most are empty.
+        Arguments: times: sorted datetime64 values
+        Returns: int seconds
+        Raises ValueError if there are fewer than two distinct times, or
+        the smallest step isn't a whole number of seconds
+    """
+    steps = np.diff(np.asarray(times).astype("datetime64[ns]").view(np.int64))
+    steps = steps[steps > 0]
+    if len(steps) == 0:
+        raise ValueError("Can't infer the bucket width from fewer than two times")
+    seconds, rest = divmod(int(steps.min()), 10**9)
+    if rest:
+        raise ValueError("Rows are {}ns apart, not whole seconds".format(int(steps.min())))
+    return seconds
+
+
+def gap_codes(times, bucket_seconds):
+    """ Codes that change wherever rows are more than one bucket apart
+        Arguments:
+            times: sorted datetime64 values
+            bucket_seconds: width of each row of the grid
+        Returns: integer array, to pass to run_starts as a break
+    """
+    steps = np.diff(np.asarray(times).astype("datetime64[ns]").view(np.int64))
+    gaps = steps > bucket_seconds * 10**9
+    return np.concatenate([[0], np.cumsum(gaps)])
+
+
+def run_positions(starts):
+    """ 1-based position of each row within its run """
+    positions = np.arange(len(starts))
+    return positions - np.maximum.accumulate(np.where(starts, positions, 0)) + 1
+
+
+def _event_starts(flags):
+    """ True at the first sample of each run of flags == 1 """
+    on = np.asarray(flags, dtype=np.float64) == 1
+    first = on.copy()
+    first[1:] &= ~on[:-1]
+    return first
+
+
+def position_episodes(df, bucket_seconds=None):
+    """ Encode the orientation series of a sleep grid as position episodes
+        Rows without a sleep night are left out, as are rows without an
+        orientation bin.
+        Arguments:
+            df: time sorted dataframe with orient_bin, sleep_night, SpO2(%)
+                and optionally ODI and low_oxygen columns
+            bucket_seconds: width of each row of the grid, inferred from
+                the index if not given
+        Returns: dataframe with one row per episode, see EPISODE_COLUMNS
+    """
+    if bucket_seconds is None:
+        bucket_seconds = infer_bucket_seconds(df.index.values)
+    night_codes = column_codes(df["sleep_night"])
+    orient_codes = column_codes(df["orient_bin"])
+    keep = (night_codes >= 0) & (orient_codes >= 0)
+    # Every dropped row is split off on its own, so the runs partition the
+    # rows and ufunc.reduceat over all run starts summarises each one
+    times = df.index.values
+    bounds = np.flatnonzero(run_starts(orient_codes, night_codes,
+                                       gap_codes(times, bucket_seconds)) | ~keep)
+    kept = keep[bounds]
+    starts = bounds[kept]
+    if len(starts) == 0:
+        return pd.DataFrame(columns=EPISODE_COLUMNS)
+    n_samples = np.diff(np.append(bounds, len(df)))[kept]
+
+    def per_episode(ufunc, values):
+        return ufunc.reduceat(values, bounds)[kept]
+
+    episodes = {
+        "start": times[starts],
+        "end": times[starts + n_samples - 1] + np.timedelta64(bucket_seconds, "s"),
+        "sleep_night": df["sleep_night"].to_numpy()[starts],
+        "orient_bin": df["orient_bin"].to_numpy()[starts],
+        "n_samples": n_samples,
+        "duration": n_samples * bucket_seconds,
+        "min_spo2": per_episode(np.fmin, df["SpO2(%)"].to_numpy(dtype=np.float64)),
+    }
+    if "ODI" in df:
+        odi = df["ODI"].to_numpy(dtype=np.float64)
+        episodes["odi_samples"] = per_episode(np.add, (odi == 1).astype(np.int64))
+        episodes["odi_events"] = per_episode(np.add, _event_starts(odi).astype(np.int64))
+    if "low_oxygen" in df:
+        low = df["low_oxygen"].to_numpy() == 1
+        episodes["low_oxygen_samples"] = per_episode(np.add, low.astype(np.int64))
+    return pd.DataFrame(episodes, columns=[name for name in EPISODE_COLUMNS
+                                           if name in episodes])
+
+
+def time_per_position(episodes):
+    """ Seconds spent in each position per night
+        Returns: dataframe indexed by sleep_night, one column per orient_bin
+    """
+    return episodes.pivot_table(index="sleep_night", columns="orient_bin",
+                                values="duration", aggfunc="sum",
+                                fill_value=0, observed=True)
+
+
+def odi_rate_per_position(episodes):
+    """ ODI events per hour spent in each position
+        Returns: dataframe indexed by orient_bin with hours, odi_events and
+            odi_rate columns
+    """
+    summary = episodes.groupby("orient_bin", observed=True).agg(
+        hours=("duration", "sum"), odi_events=("odi_events", "sum"))
+    summary["hours"] = summary["hours"] / 3600
+    summary["odi_rate"] = summary["odi_events"] / summary["hours"]
+    return summary
@@ -2,9 +2,66 @@
 
 import argparse
 import glob
+import hashlib
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
 
-import pandas as pd
+# numpy, pandas and the modules using them are imported by the functions
+# that need them, so --help doesn't wait for them
+from storage import BACKENDS, read_frame, write_frame
+
+HR_TIME_FORMAT = "%m/%d/%y %H:%M:%S"
+HR_UTC_OFFSET_HOURS = 8  # Exports are in UTC, convert to Pacific time
+HR_CHUNK_SIZE = 50000
+HR_RECORD_BYTES = 90  # Approximate size of one pretty printed reading
+
+MANIFEST_VERSION = 1
+
+SLEEP_VALUES = {'wake': 1, 'light': 0, 'deep': -1, 'rem': -2}
+
+
+def read_heart_rate_arrays(fn, chunk_size=HR_CHUNK_SIZE):
+    '''
+    Streams a heart rate json into compact, preallocated numpy arrays
+
+            Parameters:
+                    fn (str): Filename of heart rate json from fitbit
+                    chunk_size (int): Number of readings to parse at a time
+
+            Returns:
+                    datetime (np.ndarray): datetime64[s] times, shifted to local time
+                    bpm (np.ndarray): int16 heart rate
+                    confidence (np.ndarray): int8 fitbit confidence
+    '''
+    import numpy as np
+    import pandas as pd
+
+    from json_stream import iter_json_array_chunks
+
+    n_alloc = max(os.path.getsize(fn) // HR_RECORD_BYTES, chunk_size)
+    datetime = np.empty(n_alloc, dtype="datetime64[s]")
+    bpm = np.empty(n_alloc, dtype=np.int16)
+    confidence = np.empty(n_alloc, dtype=np.int8)
+
+    n = 0
+    for records in iter_json_array_chunks(fn, chunk_size):
+        end = n + len(records)
+        if end > n_alloc:
+            # The size estimate was too small, grow geometrically
+            n_alloc = max(end, n_alloc + n_alloc // 2)
+            datetime = np.resize(datetime, n_alloc)
+            bpm = np.resize(bpm, n_alloc)
+            confidence = np.resize(confidence, n_alloc)
+        datetime[n:end] = pd.to_datetime(
+            [x["dateTime"] for x in records], format=HR_TIME_FORMAT).values
+        bpm[n:end] = [x["value"]["bpm"] for x in records]
+        confidence[n:end] = [x["value"]["confidence"] for x in records]
+        n = end
+
+    # Fix difference in time zone problem
+    datetime = datetime[:n] - np.timedelta64(HR_UTC_OFFSET_HOURS, "h")
+    return datetime, bpm[:n].copy(), confidence[:n].copy()
 
 
 def create_heart_rate_df(fn):
@@ -17,18 +74,42 @@ def create_heart_rate_df(fn):
             Returns:
                     df (pd.DataFrame): Dataframe with bpm, confidence and datetime
     '''
-    with open(fn) as f:
-        file_contents = json.load(f)
-    index = pd.to_datetime([x["dateTime"] for x in file_contents])
-    # Fix difference in time zone problem
-    index = [x - pd.Timedelta(8, unit="h") for x in index]
-    data = [[x["value"]["bpm"], x["value"]["confidence"]]
-            for x in file_contents]
-    df = pd.DataFrame(data, index=index, columns=["bpm", "confidence"])
+    import pandas as pd
+
+    datetime, bpm, confidence = read_heart_rate_arrays(fn)
+    df = pd.DataFrame({"bpm": bpm, "confidence": confidence},
+                      index=pd.DatetimeIndex(datetime))
     df["datetime"] = df.index
     return df
 
 
+def read_fitbit_sleep_segments(fn):
+    '''
+    Reads the sleep stage segments from a fitbit sleep json
+
+            Parameters:
+                    fn (str): Filename of sleep json from fitbit
+
+            Returns:
+                    starts (np.ndarray): datetime64 start of each segment
+                    ends (np.ndarray): datetime64 end of each segment
+                    values (np.ndarray): Sleep state of each segment (see SLEEP_VALUES)
+    '''
+    import numpy as np
+    import pandas as pd
+
+    with open(fn) as f:
+        fitbit_sleep = json.load(f)
+
+    segments = [my_dict for night in fitbit_sleep
+                for my_dict in night['levels']['data']]
+    starts = pd.to_datetime([x['dateTime'] for x in segments]).values
+    seconds = np.array([x['seconds'] for x in segments], dtype=np.int64)
+    ends = starts + seconds.astype("timedelta64[s]")
+    values = np.array([SLEEP_VALUES[x['level']] for x in segments], dtype=np.int8)
+    return starts, ends, values
+
+
 def add_fitbit_sleep_assignments(fn, df):
     '''
     Adds fitbit's inferred sleep/awake state to df
@@ -40,29 +121,230 @@ def add_fitbit_sleep_assignments(fn, df):
             Returns:
                     df (pd.DataFrame): Dataframe with bpm, confidence, datetime, and sleep state
     '''
-    value_dict = {'wake': 1, 'light': 0, 'deep': -1, 'rem': -2}
-    with open(fn) as f:
-        fitbit_sleep = json.load(f)
+    import numpy as np
+
+    from interval_join import label_intervals
 
-    for i in range(0, len(fitbit_sleep)):
-        for my_dict in fitbit_sleep[i]['levels']['data']:
-            start = pd.Timestamp(my_dict['dateTime'])
-            end = start + pd.Timedelta(my_dict['seconds'], unit='s')
-            value_to_use = value_dict[my_dict['level']]
-            df.loc[(df['datetime'] > start) & (
-                df['datetime'] <= end), "fb_sleep"] = value_to_use
-    fitbit_sleep['minutesAsleep']
+    starts, ends, values = read_fitbit_sleep_segments(fn)
+    fill = df["fb_sleep"].values if "fb_sleep" in df else np.nan
+    df["fb_sleep"] = label_intervals(df["datetime"].values, starts, ends,
+                                     values, fill=fill)
     return(df)
 
 
+def merge_heart_rate_arrays(parts):
+    '''
+    Merges per-file heart rate arrays into one time ordered dataframe
+
+    Each file covers its own stretch of time, so once the parts are ordered
+    by their first reading they can usually just be stitched together.
+    Overlapping parts fall back to a stable sort, which finds the already
+    sorted runs and merges them rather than sorting from scratch.
+
+            Parameters:
+                    parts (list): (datetime, bpm, confidence) tuples from
+                        read_heart_rate_arrays
+
+            Returns:
+                    df (pd.DataFrame): Dataframe with bpm, confidence and datetime
+    '''
+    import numpy as np
+    import pandas as pd
+
+    sorted_parts = []
+    for datetime, bpm, confidence in parts:
+        if len(datetime) == 0:
+            continue
+        if np.any(datetime[1:] < datetime[:-1]):
+            order = np.argsort(datetime, kind="stable")
+            datetime, bpm, confidence = datetime[order], bpm[order], confidence[order]
+        sorted_parts.append((datetime, bpm, confidence))
+    sorted_parts.sort(key=lambda part: part[0][0])
+
+    if sorted_parts:
+        datetime, bpm, confidence = (np.concatenate(x) for x in zip(*sorted_parts))
+    else:
+        datetime = np.empty(0, dtype="datetime64[s]")
+        bpm = np.empty(0, dtype=np.int16)
+        confidence = np.empty(0, dtype=np.int8)
+    overlapping = any(prev[0][-1] > part[0][0]
+                      for prev, part in zip(sorted_parts, sorted_parts[1:]))
+    if overlapping:
+        order = np.argsort(datetime, kind="stable")
+        datetime, bpm, confidence = datetime[order], bpm[order], confidence[order]
+
+    df = pd.DataFrame({"bpm": bpm, "confidence": confidence},
+                      index=pd.DatetimeIndex(datetime))
+    df["datetime"] = df.index
+    return df
+
+
+def load_heart_rate(hr_files, workers=1):
+    '''
+    Parses heart rate jsons, optionally in a pool of worker processes
+
+            Parameters:
+                    hr_files (list): Filenames of heart rate jsons from fitbit
+                    workers (int): Number of processes to parse files with
+
+            Returns:
+                    df (pd.DataFrame): Time ordered dataframe with bpm, confidence and datetime
+    '''
+    if workers > 1 and len(hr_files) > 1:
+        # Workers send back numpy arrays, which pickle far smaller and
+        # faster than dataframes
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(read_heart_rate_arrays, hr_files))
+    else:
+        parts = [read_heart_rate_arrays(fn) for fn in hr_files]
+    return merge_heart_rate_arrays(parts)
+
+
+def file_fingerprint(fn):
+    '''
+    Returns the size, modification time and content hash of a file
+
+            Parameters:
+                    fn (str): Filename
+
+            Returns:
+                    fingerprint (dict): size, mtime and sha256 of the file
+    '''
+    sha = hashlib.sha256()
+    with open(fn, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    stat = os.stat(fn)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha.hexdigest()}
+
+
+def load_manifest(fn):
+    ''' Returns the {path: fingerprint} manifest in fn, or {} if there is none '''
+    if not os.path.exists(fn):
+        return {}
+    with open(fn) as f:
+        return json.load(f)["files"]
+
+
+def save_manifest(fn, files):
+    ''' Atomically writes the {path: fingerprint} manifest to fn '''
+    tmp_fn = fn + ".tmp"
+    with open(tmp_fn, "w") as f:
+        json.dump({"version": MANIFEST_VERSION, "files": files}, f, indent=1)
+    os.replace(tmp_fn, fn)
+
+
+def find_changed_files(files, manifest):
+    '''
+    Finds files that are new or have changed since the manifest was written
+
+    Files whose size and mtime match the manifest are trusted without being
+    read. Otherwise the content hash decides, so touching a file does not
+    cause it to be parsed again.
+
+            Parameters:
+                    files (list): Filenames to check
+                    manifest (dict): {path: fingerprint} of ingested files
+
+            Returns:
+                    changed (list): Filenames that need to be (re)parsed
+                    fingerprints (dict): Current {path: fingerprint} for files
+    '''
+    changed = []
+    fingerprints = {}
+    for fn in files:
+        path = os.path.abspath(fn)
+        old = manifest.get(path)
+        stat = os.stat(fn)
+        if old and old["size"] == stat.st_size and old["mtime"] == stat.st_mtime:
+            fingerprints[path] = old
+            continue
+        fingerprints[path] = file_fingerprint(fn)
+        if not old or old["sha256"] != fingerprints[path]["sha256"]:
+            changed.append(fn)
+    return changed, fingerprints
+
+
+def merge_minutes(previous, new):
+    '''
+    Merges newly parsed minutes into a previously formatted dataframe
+
+            Parameters:
+                    previous (pd.DataFrame): Earlier output, one row per minute
+                    new (pd.DataFrame): Minutes parsed from new or changed files
+
+            Returns:
+                    df (pd.DataFrame): One row per minute spanning both, new
+                        readings taking precedence
+    '''
+    import pandas as pd
+
+    index = previous.index.union(new.index)
+    index = pd.date_range(index[0], index[-1], freq="1Min")
+    df = previous[["bpm", "confidence"]].reindex(index)
+    update = new[["bpm", "confidence"]].dropna(how="all")
+    df.loc[update.index, ["bpm", "confidence"]] = update.values
+    df["datetime"] = df.index
+    return df
+
+
+def label_fitbit_sleep(df, sleep_files):
+    '''
+    Adds fitbit's inferred sleep/awake state to every minute of df
+
+            Parameters:
+                    df (pd.DataFrame): Dataframe with heart rate data
+                    sleep_files (list): Filenames of sleep jsons from fitbit
+
+            Returns:
+                    df (pd.DataFrame): Dataframe with bpm, confidence, datetime, and sleep state
+    '''
+    import numpy as np
+
+    from interval_join import label_intervals
+
+    df["fb_sleep"] = np.ones(len(df), dtype=np.int8)  # Missing data
+
+    # Label every minute in one pass over the segments of all the files
+    segments = [read_fitbit_sleep_segments(fn) for fn in sleep_files]
+    if segments:
+        starts, ends, values = (np.concatenate(x) for x in zip(*segments))
+        df["fb_sleep"] = label_intervals(df["datetime"].values, starts, ends,
+                                         values, fill=df["fb_sleep"].values)
+    return df
+
+
 def main(args):
 
     pattern_match_hr = args.in_dir + "/heart_rate*json"
     hr_files = glob.glob(pattern_match_hr)
+    pattern_match_sleep = args.in_dir + "/sleep*json"
+    sleep_files = glob.glob(pattern_match_sleep)
+    print(sleep_files)
+
+    out_fn = args.out_dir + "/20201229_hr_sleep_1min_first." + args.out_format
+    manifest_fn = out_fn + ".manifest.json"
 
-    frames = [create_heart_rate_df(fn) for fn in hr_files]
-    df = pd.concat(frames)
-    df.sort_values(by="datetime", inplace=True)
+    # Files are only fingerprinted when the manifest is used
+    manifest = {}
+    changed = hr_files + sleep_files
+    if args.incremental:
+        if os.path.exists(out_fn):
+            manifest = load_manifest(manifest_fn)
+        changed, fingerprints = find_changed_files(hr_files + sleep_files, manifest)
+        removed = set(manifest) - set(fingerprints)
+        if removed:
+            # Their minutes can't be picked out of the output, so start over
+            print('{} files removed since the last run, parsing all files'.format(len(removed)))
+            manifest = {}
+            changed = hr_files + sleep_files
+        elif manifest and not changed:
+            print('No new or changed files since the last run')
+            return
+    hr_to_parse = [fn for fn in changed if fn not in sleep_files]
+    print('Heart rate files to parse: {}'.format(len(hr_to_parse)))
+
+    df = load_heart_rate(hr_to_parse, workers=args.workers)
     print('Raw rows: {}'.format(df.shape[0]))
 
     # Take just first reading per minute
@@ -70,19 +352,23 @@ def main(args):
     df["datetime"] = df.index
     print('Resampled rows (1Min): {}'.format(df.shape[0]))
 
-    df["fb_sleep"] = 1  # Missing data
-    pattern_match_sleep = args.in_dir + "/sleep*json"
-    sleep_files = glob.glob(pattern_match_sleep)
-    print(sleep_files)
+    if manifest:
+        previous = read_frame(out_fn, columns=["bpm", "confidence"])
+        df = merge_minutes(previous, df)
+        print('Rows after merging with {}: {}'.format(out_fn, df.shape[0]))
 
-    for sleep_fn in sleep_files:
-        df = add_fitbit_sleep_assignments(sleep_fn, df)
-    out_fn = args.out_dir + "/20201229_hr_sleep_1min_first.csv"
-    df.to_csv(out_fn)
+    df = label_fitbit_sleep(df, sleep_files)
+    write_frame(df, out_fn)
+    if args.incremental:
+        save_manifest(manifest_fn, fingerprints)
+    elif os.path.exists(manifest_fn):
+        # It describes an output that was just replaced
+        os.remove(manifest_fn)
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+def build_parser(prog=None):
+    ''' Command line arguments, also used by the digitalhealth.py subcommand '''
+    parser = argparse.ArgumentParser(prog=prog, description=__doc__)
     parser.add_argument(
         "--in_dir",
         help="Input directory with heart rate data",
@@ -91,5 +377,29 @@ if __name__ == "__main__":
         "--out_dir",
         help="Output directory with heart rate data",
         default="/Users/kmcmanus/Documents/classes/digitalhealth_project/data/formatted_data")
-    args = parser.parse_args()
+    parser.add_argument(
+        "--out_format",
+        help="Storage format of the output file",
+        choices=sorted(BACKENDS),
+        default="csv")
+    parser.add_argument(
+        "--workers",
+        help="Number of processes used to parse the heart rate files",
+        type=int,
+        default=1)
+    parser.add_argument(
+        "--incremental",
+        help="Only parse files that are new or changed since the last run "
+             "and merge them into the existing output. If files were removed "
+             "since then, everything is parsed again",
+        action="store_true")
+    return parser
+
+
+def cli(argv=None, prog=None):
+    args = build_parser(prog).parse_args(argv)
     main(args)
+
+
+if __name__ == "__main__":
+    cli()
@@ -7,15 +7,26 @@ Outputs a file with the data merged and cleaned.
 import click
 import glob
 
-import pandas as pd
-import numpy as np
+# pandas and the modules using it are imported by the functions that need
+# them, so --help doesn't wait for them
+from recording import (DEFAULT_TIMEZONE, NIGHT_CUTOFF, ODI_DETECTOR_NAMES, parse_bucket,
+                       parse_night_cutoff, sleep_night_days)
+from storage import write_frame
 
 
-def read_files(files):
+def read_files(files, schema=None):
     """ Read in list of files and concatenate them into a dataframe 
         Arguments: files: list of string filenames
+                   schema: optional name of a schema in typed_csv.SCHEMAS,
+                       to read just its columns with narrow dtypes
         Returns: dataframe of data
     """
+    import pandas as pd
+
+    from typed_csv import read_typed_csv
+
+    if schema is not None:
+        return read_typed_csv(files, schema)
     dfs = []
     for fn in files:
         df = pd.read_csv(fn)
@@ -24,127 +35,157 @@ def read_files(files):
     return all_df
 
 
-def identify_odi(x):
-    """ Identify intervals that count an an ODI.
-    Input: list of SpO2 values
-    Output: value, np.nan: missing data, 1: ODI event, 0: no ODI event
-    """
-    if len(x) < 2:
-        return np.nan
-    if x.max() <= 91.0:
-        return 1
-    return 0
-
-
-def assign_odi(df):
+def assign_odi(df, detector="threshold"):
     """ Read in df, create a new column that assigns an 'ODI' event.
     The position data isn't relevant for this call.
     An 'ODI' event is typically defined as a drop of ~4% from baseline
-    for at least 10 seconds (https://www.ncbi.nlm.nih.gov/pmc/articles/PMC6017211/).
-    Based on the data available, I'm going to call an ODI event to be
-    when SpO2 dropped to <= 91% for at least 2 consecutive measurements.
-    Note that the time frequency returns the BEGINNING of the interval
+    for at least 10 seconds (https://www.ncbi.nlm.nih.gov/pmc/articles/PMC6017211/),
+    which is the "desaturation" detector.
+    The default "threshold" detector calls an ODI event when SpO2
+    dropped to <= 91% for at least 2 consecutive measurements
+    within a 10 second interval.
+    See odi.py for both.
 
     Arguments: 
-        Input: Dataframe of O2 data
+        Input: Dataframe of O2 data, sorted by datetime
+               detector: name of a detector in odi.ODI_DETECTORS
         Returns: Same dataframe with additional ODI column
     """
-    gpy = df["SpO2(%)"].groupby(pd.Grouper(level="datetime", freq="10S"))
-    odi = gpy.transform(identify_odi).reset_index().rename(columns={"SpO2(%)": "ODI"})
-    df_odi = pd.merge(df, odi, on="datetime", how="left")
-    df_odi = df_odi.set_index("datetime")
-    print(df_odi.head())
-    return df_odi
+    from odi import ODI_DETECTORS
+
+    detect = ODI_DETECTORS[detector]
+    df["ODI"] = detect(df.index.values, df["SpO2(%)"].values)
+    print(df.head())
+    return df
 
 
-def assign_sleep_night(df):
+def assign_sleep_night(df, cutoff=NIGHT_CUTOFF, as_categorical=True):
     """ Since nights span two dates, create a new column that assigns
         a 'sleep night' to be the date the night starts on
         Arguments: dataframe of sleep pos data
+                   cutoff: "HH:MM" time of day that nights start at
+                   as_categorical: store a categorical of dates rather than
+                       int32 day numbers
         Returns: Same dataframe with new 'sleep_night' column
     """
-    df["sleep_night"] = None
-    dates = np.unique(df.index.date)
-
-    for i in range(0, len(dates)-1):
-        start = pd.to_datetime("{} 17:00:00".format(dates[i]))
-        if i < len(dates)-2:
-            end = pd.to_datetime("{} 16:59:59".format(dates[i+1]))
-            df.loc[start:end, "sleep_night"] = dates[i]
-        else:
-            df.loc[df.index > start, "sleep_night"] = dates[i]
+    import pandas as pd
+
+    days = sleep_night_days(df.index, cutoff)
+    if as_categorical:
+        codes, nights = pd.factorize(days, sort=True)
+        df["sleep_night"] = pd.Categorical.from_codes(
+            codes, categories=pd.to_datetime(nights.astype("datetime64[D]")))
+    else:
+        df["sleep_night"] = days
     return df
 
 
-def format_sleep_pos(sleep_pos_folder):
+def format_sleep_pos(sleep_pos_folder, timezone=DEFAULT_TIMEZONE):
     """ Initially formats sleep position data
         Arguments: String name of folder with the data
+                   timezone: time zone the recordings were made in
         Returns: Datafrmae with sleep data
     """
+    from timestamps import apple_epoch_to_datetime
+
     pattern_match_sleep_pos = sleep_pos_folder + "/SomnoPos*.csv"
     pos_files = glob.glob(pattern_match_sleep_pos)
-    pos_df = read_files(pos_files)
+    pos_df = read_files(pos_files, schema="somnopose")
     print("Position df lines: {}".format(pos_df.shape[0]))
-    # Fills NA dates with the most recent non-NA date
-    pos_df["Date"] = pos_df["Date"].fillna(method="ffill")
-    # Drop any row with a NA in any row
-    # This should just drop the first minute of recordings
-    # TODO(kmcmanus): Probably want to solve the NAs
-    pos_df = pos_df.dropna()
-    pos_df["datetime"] = pd.to_datetime(pos_df["Time_of_day"] + " " + pos_df["Date"])
-    pos_df.index = pos_df["datetime"]
+    # Time_of_day and Date are only derived from Timestamp for display
+    # (Date is only written once a minute), so decode Timestamp directly.
+    # They aren't read at all (see typed_csv.SCHEMAS).
+    pos_df = pos_df.dropna(subset=["Timestamp", "Orientation", "Inclination"])
+    pos_df.index = apple_epoch_to_datetime(pos_df["Timestamp"].values, tz=timezone)
+    pos_df.index.name = "datetime"
     pos_df = pos_df.sort_index()
-    pos_df = assign_sleep_night(pos_df)
-    pos_df = pos_df.drop(["Timestamp", "datetime", "Time_of_day", "Date"], axis=1)
+    pos_df = pos_df.drop(["Timestamp"], axis=1)
     print("Position df lines (after dropping dups and NAs): {}".format(pos_df.shape[0]))
-    pos_df = pos_df.resample("5S").first()
-    print("Position df lines after resampling (5S): {}".format(pos_df.shape[0]))
     return pos_df
 
 
-def format_o2(o2_folder):
+def format_o2(o2_folder, odi_detector="threshold"):
     """ Initially formats sleep o2 data
         Arguments: String name of folder with the data
+                   odi_detector: name of a detector in odi.ODI_DETECTORS
         Returns: Datafrmae with sleep data
     """
+    import pandas as pd
+
     pattern_match_o2 = o2_folder + "/O2Ring-*OXIRecord.csv"
     o2_files = glob.glob(pattern_match_o2)
-    o2_df = read_files(o2_files)
+    o2_df = read_files(o2_files, schema="o2ring")
     print("SpO2 lines: {}".format(o2_df.shape[0]))
 
     # It looks like the last few measurements of each file are bogus
     print("Lines removed with SpO2(%) > 100: {}".format(o2_df[o2_df["SpO2(%)"] > 100].shape[0]))
     o2_df = o2_df[o2_df["SpO2(%)"] <= 100]
 
-    o2_df["datetime"] = pd.to_datetime(o2_df["Time"], format="%H:%M:%S %b %d %Y")
-    o2_df.index = o2_df["datetime"]
-    o2_df = o2_df.drop(["datetime", "Time"], axis=1)
+    # The Time strings are already decoded by read_files
+    o2_df.index = pd.DatetimeIndex(o2_df["Time"].values, name="datetime")
+    o2_df = o2_df.drop(["Time"], axis=1)
     o2_df = o2_df.sort_index()
 
-    o2_odi_df = assign_odi(o2_df)
-
-    o2_odi_df = o2_odi_df.resample("5S").first()
-    print("SpO2 lines after resampling (5S): {}".format(o2_odi_df.shape[0]))
+    o2_odi_df = assign_odi(o2_df, detector=odi_detector)
     return o2_odi_df
 
 
+def validate_night_cutoff(ctx, param, value):
+    """ click callback, a usage error for a malformed --night_cutoff """
+    try:
+        parse_night_cutoff(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    return value
+
+
+def validate_bucket(ctx, param, value):
+    """ click callback, a usage error for a --bucket reduce can't count hours of """
+    try:
+        parse_bucket(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    return value
+
+
 @click.command()
 @click.option("--sleep_pos_folder", help="File with sleep position data.",
     default="/Users/kmcmanus/Documents/classes/digitalhealth_project/data/sleep_position")
 @click.option("--o2_folder", help="Folder with Wellue records",
     default="/Users/kmcmanus/Documents/classes/digitalhealth_project/data/wellvue_o2_data")
-@click.option("--out_filename", help="Output filename",
+@click.option("--out_filename", help="Output filename, the extension (.csv, .parquet or .feather) sets the format",
     default="/Users/kmcmanus/Documents/classes/digitalhealth_project/data/formatted_data/20200628_sleep_pos_5S.csv")
-def main(sleep_pos_folder, o2_folder, out_filename):
-
-    pos_df = format_sleep_pos(sleep_pos_folder)
-
-    o2_df = format_o2(o2_folder)
-
-    merged_df = pd.merge(pos_df, o2_df, how="outer", left_index=True, right_index=True)
-    
-    merged_df = assign_sleep_night(merged_df)
-    merged_df.to_csv(out_filename)
+@click.option("--cache_dir", default=None,
+    help="Also write a memory mapped column cache of the output to this directory")
+@click.option("--odi_detector", type=click.Choice(ODI_DETECTOR_NAMES),
+    default="threshold", help="How ODI events are detected (see odi.py)")
+@click.option("--bucket", default="5s", callback=validate_bucket,
+    help="Width of the time buckets the two devices are merged on, "
+         "whole seconds that divide an hour")
+@click.option("--tolerance", default=None,
+    help="Fill a bucket a device has no sample in from its latest sample "
+         "up to this long before (e.g. 10s). By default only exact buckets match.")
+@click.option("--timezone", default=DEFAULT_TIMEZONE,
+    help="Time zone the sleep position recordings were made in")
+@click.option("--night_cutoff", default=NIGHT_CUTOFF, callback=validate_night_cutoff,
+    help="Time of day (HH:MM or HH:MM:SS) that each sleep night starts at")
+def main(sleep_pos_folder, o2_folder, out_filename, cache_dir, odi_detector,
+         bucket, tolerance, timezone, night_cutoff):
+    from stream_merge import bucket_merge
+
+    pos_df = format_sleep_pos(sleep_pos_folder, timezone=timezone)
+
+    o2_df = format_o2(o2_folder, odi_detector=odi_detector)
+
+    # Only buckets where at least one device recorded are kept
+    merged_df = bucket_merge([pos_df, o2_df], freq=bucket, tolerance=tolerance)
+    print("Merged lines ({} buckets with data): {}".format(bucket, merged_df.shape[0]))
+
+    merged_df = assign_sleep_night(merged_df, cutoff=night_cutoff)
+    write_frame(merged_df, out_filename)
+    if cache_dir:
+        from column_cache import write_column_cache
+        write_column_cache(merged_df, cache_dir)
 
 
 if __name__ == '__main__':
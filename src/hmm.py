@@ -0,0 +1,493 @@
+""" Gaussian hidden Markov models fit with Baum-Welch, in NumPy.
+
+Replaces the TensorFlow Probability BaumWelch class that
+optimize_hmm_parameters.py used to import from outside the repo. Emission
+probabilities are computed in log space and the forward-backward recursions
+are scaled at every step, so long sequences neither underflow nor need
+TensorFlow. The recursions are compiled with numba when it is installed
+and fall back to NumPy vectorized over the states otherwise. Parameters can
+carry a leading restart axis, so fit_restarts advances many random starts
+together.
+"""
+
+import collections
+import functools
+import importlib.util
+
+import numpy as np
+
+# numba is slow to import, so it is only imported (and the kernels
+# compiled) the first time the numba engine is used
+HAS_NUMBA = importlib.util.find_spec("numba") is not None
+
+ENGINES = ["auto", "numpy", "numba"]
+
+MIN_STDEV = 1e-3
+
+HMMParams = collections.namedtuple(
+    "HMMParams", ["initial", "transition", "means", "stdevs"])
+
+
+def random_start(rng=None):
+    """ Random 2 state starting values for heart rate data
+        Same ranges the TensorFlow version drew from: sticky transitions,
+        a resting state mean of 55-66 bpm and an active state of 75-89 bpm.
+        Arguments: rng: np.random.Generator, a new one if None
+        Returns: HMMParams
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    stay = rng.uniform(low=0.9, high=0.99, size=2)
+    return HMMParams(
+        initial=np.array([0.66, 0.33]) / 0.99,
+        transition=np.array([[stay[0], 1 - stay[0]],
+                             [1 - stay[1], stay[1]]]),
+        means=np.array([rng.integers(55, 67), rng.integers(75, 90)], dtype=np.float64),
+        stdevs=rng.integers(2, 10, size=2).astype(np.float64))
+
+
+def stack_params(params_list):
+    """ Stack HMMParams along a new leading restart axis """
+    return HMMParams(*(np.stack(values) for values in zip(*params_list)))
+
+
+def select_params(params, index):
+    """ Restarts `index` (an int or an index array) of batched HMMParams """
+    return HMMParams(*(values[index] for values in params))
+
+
+def log_emissions(observations, means, stdevs):
+    """ Log density of each observation under each state's normal
+        Returns: (num_steps, num_states) array, or (num_restarts, num_steps,
+            num_states) for batched means and stdevs
+    """
+    z = (observations[:, None] - means[..., None, :]) / stdevs[..., None, :]
+    return -0.5 * z ** 2 - np.log(stdevs)[..., None, :] - 0.5 * np.log(2 * np.pi)
+
+
+# The kernels take arrays with a leading restart axis:
+# emissions, alpha and beta are (num_restarts, num_steps, num_states),
+# scale is (num_restarts, num_steps). The forward kernels start from
+# `initial`, the predicted state distribution of the first step, and the
+# backward kernels from beta[:, -1], which the caller fills in.
+
+def _forward_numpy(emissions, initial, transition, alpha, scale):
+    alpha[:, 0] = initial * emissions[:, 0]
+    scale[:, 0] = alpha[:, 0].sum(axis=1)
+    alpha[:, 0] /= scale[:, 0, None]
+    for t in range(1, emissions.shape[1]):
+        alpha[:, t] = np.matmul(alpha[:, t - 1, None, :], transition)[:, 0] * emissions[:, t]
+        scale[:, t] = alpha[:, t].sum(axis=1)
+        alpha[:, t] /= scale[:, t, None]
+
+
+def _backward_numpy(emissions, transition, scale, beta):
+    for t in range(emissions.shape[1] - 2, -1, -1):
+        beta[:, t] = np.matmul(transition, (emissions[:, t + 1] * beta[:, t + 1])[..., None])[..., 0]
+        beta[:, t] /= scale[:, t + 1, None]
+
+
+def _forward_loops(emissions, initial, transition, alpha, scale):
+    num_restarts, num_steps, num_states = emissions.shape
+    for r in range(num_restarts):
+        total = 0.0
+        for j in range(num_states):
+            alpha[r, 0, j] = initial[r, j] * emissions[r, 0, j]
+            total += alpha[r, 0, j]
+        scale[r, 0] = total
+        for j in range(num_states):
+            alpha[r, 0, j] /= total
+        for t in range(1, num_steps):
+            total = 0.0
+            for j in range(num_states):
+                acc = 0.0
+                for i in range(num_states):
+                    acc += alpha[r, t - 1, i] * transition[r, i, j]
+                alpha[r, t, j] = acc * emissions[r, t, j]
+                total += alpha[r, t, j]
+            scale[r, t] = total
+            for j in range(num_states):
+                alpha[r, t, j] /= total
+
+
+def _backward_loops(emissions, transition, scale, beta):
+    num_restarts, num_steps, num_states = emissions.shape
+    for r in range(num_restarts):
+        for t in range(num_steps - 2, -1, -1):
+            for i in range(num_states):
+                acc = 0.0
+                for j in range(num_states):
+                    acc += transition[r, i, j] * emissions[r, t + 1, j] * beta[r, t + 1, j]
+                beta[r, t, i] = acc / scale[r, t + 1]
+
+
+@functools.lru_cache(maxsize=None)
+def _numba_kernels():
+    import numba
+    return numba.njit(cache=True)(_forward_loops), numba.njit(cache=True)(_backward_loops)
+
+
+def _kernels(engine):
+    if engine == "auto":
+        engine = "numba" if HAS_NUMBA else "numpy"
+    if engine == "numba":
+        if not HAS_NUMBA:
+            raise ImportError("The numba engine needs numba installed")
+        return _numba_kernels()
+    if engine == "numpy":
+        return _forward_numpy, _backward_numpy
+    raise ValueError("Unknown engine {}, expected one of {}".format(engine, ENGINES))
+
+
+def contiguous_segments(times, step):
+    """ Split sorted sample times where consecutive samples are more than
+        step apart, e.g. the minutes dropped for having no heart rate
+        Arguments:
+            times: sorted datetime64 array
+            step: spacing of the samples, as np.timedelta64
+        Returns: arrays of segment starts and stops (exclusive)
+    """
+    times = np.asarray(times)
+    breaks = np.flatnonzero(np.diff(times) > step) + 1
+    return np.append(0, breaks), np.append(breaks, len(times))
+
+
+def _emissions(observations, params):
+    """ Emission probabilities of batched params, each step shifted so its
+        largest log density is 0 before leaving log space
+        Returns: emissions and the shifts, which add back to the log likelihood
+    """
+    log_b = log_emissions(observations, params.means, params.stdevs)
+    shift = log_b.max(axis=2)
+    return np.exp(log_b - shift[..., None]), shift
+
+
+def _forward_chunk(forward, emissions, initial, transition):
+    alpha = np.empty_like(emissions)
+    scale = np.empty(emissions.shape[:2])
+    forward(emissions, np.ascontiguousarray(initial), transition, alpha, scale)
+    return alpha, scale
+
+
+def forward_backward(observations, params, engine="auto"):
+    """ Scaled forward-backward pass
+        Arguments:
+            observations: 1d float array
+            params: HMMParams, optionally batched with a leading restart axis
+            engine: one of ENGINES
+        Returns: log likelihood, state posteriors (num_steps, num_states)
+            and expected transition counts (num_states, num_states), each
+            with a leading restart axis if params has one
+    """
+    batched = np.ndim(params.means) == 2
+    if not batched:
+        params = stack_params([params])
+    forward, backward = _kernels(engine)
+    emissions, shift = _emissions(observations, params)
+    alpha, scale = _forward_chunk(forward, emissions, params.initial, params.transition)
+    beta = np.empty_like(emissions)
+    beta[:, -1] = 1.0
+    backward(emissions, params.transition, scale, beta)
+
+    posteriors = alpha * beta
+    weighted = emissions[:, 1:] * beta[:, 1:] / scale[:, 1:, None]
+    transitions = params.transition * np.matmul(alpha[:, :-1].transpose(0, 2, 1), weighted)
+    log_likelihood = np.log(scale).sum(axis=1) + shift.sum(axis=1)
+    if not batched:
+        return log_likelihood[0], posteriors[0], transitions[0]
+    return log_likelihood, posteriors, transitions
+
+
+def _new_statistics(num_restarts, num_states):
+    shape = (num_restarts, num_states)
+    return {"initial": np.zeros(shape), "transitions": np.zeros(shape + (num_states,)),
+            "weights": np.zeros(shape), "sum_x": np.zeros(shape), "sum_x2": np.zeros(shape)}
+
+
+def _add_statistics(stats, observations, posteriors):
+    stats["weights"] += posteriors.sum(axis=-2)
+    stats["sum_x"] += np.einsum("...tk,t->...k", posteriors, observations)
+    stats["sum_x2"] += np.einsum("...tk,t->...k", posteriors, observations ** 2)
+
+
+def params_from_statistics(stats):
+    """ Maximum likelihood parameters given summed expected statistics """
+    weights = stats["weights"]
+    means = stats["sum_x"] / weights
+    variances = np.maximum(stats["sum_x2"] / weights - means ** 2, 0)
+    initial = stats["initial"]
+    transitions = stats["transitions"]
+    return HMMParams(
+        initial=initial / initial.sum(axis=-1, keepdims=True),
+        transition=transitions / transitions.sum(axis=-1, keepdims=True),
+        means=means,
+        stdevs=np.maximum(np.sqrt(variances), MIN_STDEV))
+
+
+def m_step(observations, posteriors, transitions):
+    """ Maximum likelihood parameters given the expected state counts,
+        batched if posteriors and transitions have a leading restart axis
+    """
+    stats = {"initial": posteriors[..., 0, :], "transitions": transitions,
+             "weights": 0, "sum_x": 0, "sum_x2": 0}
+    _add_statistics(stats, observations, posteriors)
+    return params_from_statistics(stats)
+
+
+def _segment_statistics(observations, params, chunk_size, forward, backward, stats):
+    """ Add one segment's expected statistics to stats, chunk by chunk
+        The forward pass keeps only the predicted state distribution at
+        the start of each chunk. The backward pass then visits the chunks
+        in reverse, recomputes each chunk's forward messages from its
+        checkpoint and hands the next chunk's first backward message on,
+        so memory is bounded by chunk_size rather than the segment length.
+        Returns: log likelihood of the segment per restart
+    """
+    transition = params.transition
+    bounds = range(0, len(observations), chunk_size)
+    checkpoints = [params.initial]
+    log_likelihood = 0
+    for lo in bounds:
+        emissions, shift = _emissions(observations[lo:lo + chunk_size], params)
+        alpha, scale = _forward_chunk(forward, emissions, checkpoints[-1], transition)
+        log_likelihood = log_likelihood + np.log(scale).sum(axis=1) + shift.sum(axis=1)
+        checkpoints.append(np.matmul(alpha[:, -1, None, :], transition)[:, 0])
+
+    # emissions * beta / scale at the first step of the following chunk
+    message = None
+    for i in reversed(range(len(bounds))):
+        chunk = observations[bounds[i]:bounds[i] + chunk_size]
+        if message is not None:
+            # The last chunk's forward messages are still at hand
+            emissions, _ = _emissions(chunk, params)
+            alpha, scale = _forward_chunk(forward, emissions, checkpoints[i], transition)
+        beta = np.empty_like(emissions)
+        if message is None:
+            beta[:, -1] = 1.0
+        else:
+            beta[:, -1] = np.matmul(transition, message[..., None])[..., 0]
+            stats["transitions"] += transition * alpha[:, -1, :, None] * message[:, None, :]
+        backward(emissions, transition, scale, beta)
+
+        posteriors = alpha * beta
+        weighted = emissions[:, 1:] * beta[:, 1:] / scale[:, 1:, None]
+        stats["transitions"] += transition * np.matmul(alpha[:, :-1].transpose(0, 2, 1), weighted)
+        _add_statistics(stats, chunk, posteriors)
+        message = emissions[:, 0] * beta[:, 0] / scale[:, 0, None]
+    stats["initial"] += posteriors[:, 0]
+    return log_likelihood
+
+
+def expected_statistics(observations, params, segments=None, chunk_size=None,
+                        engine="auto"):
+    """ E step over independent segments, in chunks of bounded memory
+        Arguments:
+            observations: 1d float array
+            params: HMMParams with a leading restart axis
+            segments: (starts, stops) of segments that each start from the
+                initial distribution (see contiguous_segments), or None for
+                one segment
+            chunk_size: most steps held in memory at once, None for whole
+                segments
+            engine: one of ENGINES
+        Returns: log likelihood per restart, and a dict of the expected
+            statistics summed over all segments
+    """
+    forward, backward = _kernels(engine)
+    if segments is None:
+        segments = ([0], [len(observations)])
+    stats = _new_statistics(*params.means.shape)
+    log_likelihood = np.zeros(len(params.means))
+    for start, stop in zip(*segments):
+        log_likelihood += _segment_statistics(
+            observations[start:stop], params, chunk_size or stop - start,
+            forward, backward, stats)
+    return log_likelihood, stats
+
+
+def _as_float_params(params):
+    return HMMParams(*(np.ascontiguousarray(x, dtype=np.float64) for x in params))
+
+
+def baum_welch(observations, params, epsilon=0.5, max_steps=50, segments=None,
+               chunk_size=None, engine="auto"):
+    """ Fit a Gaussian HMM with expectation maximization
+        Arguments:
+            observations: 1d array
+            params: HMMParams to start from
+            epsilon: stop once the log likelihood improves by less than this
+            max_steps: most EM iterations to run
+            segments, chunk_size: see expected_statistics
+            engine: one of ENGINES
+        Returns: fitted HMMParams and the log likelihood of each step
+    """
+    params, results = fit_restarts(observations, [params], epsilon=epsilon,
+                                   max_steps=max_steps, segments=segments,
+                                   chunk_size=chunk_size, engine=engine)
+    return params, results[0]["log_likelihood"]
+
+
+def fit_restarts(observations, starts, epsilon=0.5, max_steps=50,
+                 cull_after=3, cull_margin=None, segments=None,
+                 chunk_size=None, engine="auto"):
+    """ Fit many random restarts together, as one batched EM
+        Every step runs forward-backward and the M step for all restarts
+        that are still running at once. A restart stops when it converges
+        (as in baum_welch) or, with cull_margin set, when after cull_after
+        steps its log likelihood is more than cull_margin below the best.
+        Arguments:
+            observations: 1d array
+            starts: list of HMMParams, or HMMParams with a restart axis
+            epsilon: stop a restart once it improves by less than this
+            max_steps: most EM iterations to run
+            cull_after: steps to run before any restart is culled
+            cull_margin: log likelihood gap to the best restart that gets a
+                restart culled, None to never cull
+            segments, chunk_size: see expected_statistics
+            engine: one of ENGINES
+        Returns: HMMParams of the best restart, and a list with a dict per
+            restart of its start, fit, log likelihood history and status
+            (converged, culled or max_steps)
+    """
+    observations = np.ascontiguousarray(observations, dtype=np.float64)
+    if not isinstance(starts, HMMParams):
+        starts = stack_params(starts)
+    starts = _as_float_params(starts)
+    params = HMMParams(*(values.copy() for values in starts))
+    num_restarts = len(params.means)
+    histories = [[] for _ in range(num_restarts)]
+    status = ["max_steps"] * num_restarts
+    active = np.arange(num_restarts)
+
+    for step in range(max_steps):
+        if len(active) == 0:
+            break
+        log_likelihood, stats = expected_statistics(
+            observations, select_params(params, active), segments=segments,
+            chunk_size=chunk_size, engine=engine)
+        fitted = params_from_statistics(stats)
+        for values, new_values in zip(params, fitted):
+            values[active] = new_values
+
+        running = np.ones(len(active), dtype=bool)
+        for i, r in enumerate(active):
+            histories[r].append(float(log_likelihood[i]))
+            if len(histories[r]) > 1 and histories[r][-1] - histories[r][-2] < epsilon:
+                status[r] = "converged"
+                running[i] = False
+        if cull_margin is not None and step + 1 >= cull_after:
+            best = max(history[-1] for history in histories if history)
+            behind = running & (log_likelihood < best - cull_margin)
+            for r in active[behind]:
+                status[r] = "culled"
+            running &= ~behind
+        active = active[running]
+
+    best = int(np.argmax([history[-1] for history in histories]))
+    results = [{"start": params_to_dict(select_params(starts, r)),
+                "fit": params_to_dict(select_params(params, r)),
+                "log_likelihood": histories[r],
+                "status": status[r]}
+               for r in range(num_restarts)]
+    return select_params(params, best), results
+
+
+def params_to_dict(params):
+    """ JSON friendly version of HMMParams """
+    return {name: np.asarray(value).tolist() for name, value in params._asdict().items()}
+
+
+def params_from_dict(values):
+    """ HMMParams from the output of params_to_dict """
+    return HMMParams(*(np.asarray(values[name], dtype=np.float64)
+                       for name in HMMParams._fields))
+
+
+def pad_segments(values, starts, stops, fill=np.nan):
+    """ Stack segments of a 1d array as the rows of a 2d array
+        Arguments:
+            values: 1d array
+            starts, stops: segment bounds, as from contiguous_segments
+            fill: value for the padding after shorter segments
+        Returns: (num_segments, longest segment) array and the mask of the
+            entries that hold values, values == rows[mask]
+    """
+    starts, stops = np.asarray(starts), np.asarray(stops)
+    lengths = stops - starts
+    mask = np.arange(lengths.max(initial=0))[None, :] < lengths[:, None]
+    rows = np.full(mask.shape, fill, dtype=np.result_type(values, fill))
+    for i, (start, stop) in enumerate(zip(starts, stops)):
+        rows[i, :stop - start] = values[start:stop]
+    return rows, mask
+
+
+def _batch_log_emissions(observations, params):
+    """ Log densities of 2d observations under single params, 0 (no
+        information) where an observation is NaN, missing or padding
+    """
+    log_b = log_emissions(observations.ravel(), params.means, params.stdevs)
+    log_b = log_b.reshape(observations.shape + (len(params.means),))
+    log_b[np.isnan(observations)] = 0
+    return log_b
+
+
+def viterbi(observations, params):
+    """ Most likely state sequence of each row, e.g. one night per row
+        Arguments:
+            observations: (num_rows, num_steps) array, NaN for missing
+                readings and for padding after the end of a row
+            params: HMMParams, without a restart axis
+        Returns: int8 (num_rows, num_steps) array of states. Missing
+            readings get the state that best fits the path around them.
+    """
+    observations = np.asarray(observations, dtype=np.float64)
+    log_b = _batch_log_emissions(observations, params)
+    with np.errstate(divide="ignore"):
+        log_a = np.log(params.transition)
+        delta = np.log(params.initial) + log_b[:, 0]
+    num_rows, num_steps, num_states = log_b.shape
+    # Rows end at their last reading, the padding after it is ignored
+    present = ~np.isnan(observations)
+    lengths = np.where(present.any(axis=1),
+                       num_steps - np.argmax(present[:, ::-1], axis=1), 1)
+
+    backpointers = np.zeros((num_rows, num_steps, num_states), dtype=np.int8)
+    last = delta.argmax(axis=1)
+    for t in range(1, num_steps):
+        scores = delta[:, :, None] + log_a
+        backpointers[:, t] = scores.argmax(axis=1)
+        delta = scores.max(axis=1) + log_b[:, t]
+        ending = lengths == t + 1
+        last[ending] = delta[ending].argmax(axis=1)
+
+    rows = np.arange(num_rows)
+    states = np.zeros((num_rows, num_steps), dtype=np.int8)
+    state = last
+    for t in range(num_steps - 1, -1, -1):
+        state = np.where(lengths - 1 == t, last, state)
+        states[:, t] = state
+        state = backpointers[rows, t, state]
+    return states
+
+
+def posterior_decode(observations, params, engine="auto"):
+    """ State posteriors of each row, e.g. one night per row
+        Arguments:
+            observations: (num_rows, num_steps) array, NaN for missing
+                readings and for padding after the end of a row
+            params: HMMParams, without a restart axis
+            engine: one of ENGINES
+        Returns: (num_rows, num_steps, num_states) posterior probabilities
+    """
+    forward, backward = _kernels(engine)
+    observations = np.asarray(observations, dtype=np.float64)
+    log_b = _batch_log_emissions(observations, params)
+    emissions = np.exp(log_b - log_b.max(axis=2, keepdims=True))
+    num_rows = len(observations)
+    initial = np.repeat(params.initial[None, :], num_rows, axis=0)
+    transition = np.repeat(params.transition[None, :, :], num_rows, axis=0)
+
+    alpha, scale = _forward_chunk(forward, emissions, initial, transition)
+    beta = np.empty_like(emissions)
+    beta[:, -1] = 1.0
+    backward(emissions, transition, scale, beta)
+    return alpha * beta
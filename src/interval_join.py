@@ -0,0 +1,65 @@
+''' Label time points by the intervals that contain them '''
+
+import numpy as np
+
+
+def _as_ns(values):
+    ''' Coerce datetime-like input to a datetime64[ns] numpy array '''
+    return np.asarray(values).astype("datetime64[ns]")
+
+
+def label_intervals(points, starts, ends, labels, fill=np.nan):
+    '''
+    Assigns each time point the label of the interval (start, end] containing it
+
+    Intervals are left-open and right-closed. When intervals overlap the one
+    that comes later in the input wins, the same as assigning them in a loop.
+
+            Parameters:
+                    points (array-like): Datetimes to label
+                    starts (array-like): Datetimes each interval starts after
+                    ends (array-like): Datetimes each interval ends on
+                    labels (array-like): Label for each interval
+                    fill (scalar or array-like): Value for points outside all
+                        intervals, either a scalar or one value per point
+
+            Returns:
+                    out (np.ndarray): One label per point
+    '''
+    points = _as_ns(points)
+    starts = _as_ns(starts)
+    ends = _as_ns(ends)
+    labels = np.asarray(labels)
+
+    out = np.empty(len(points), dtype=np.result_type(labels, np.asarray(fill)))
+    out[:] = fill
+    if len(starts) == 0 or len(points) == 0:
+        return out
+
+    # Sort by start then end. Repeated intervals (e.g. the same sleep log in
+    # two exports) are collapsed, keeping the one that came last.
+    order = np.lexsort((np.arange(len(starts)), ends, starts))
+    keep = np.ones(len(order), dtype=bool)
+    keep[:-1] = ((starts[order][:-1] != starts[order][1:]) |
+                 (ends[order][:-1] != ends[order][1:]))
+    order = order[keep]
+    sorted_starts, sorted_ends = starts[order], ends[order]
+
+    if np.all(sorted_ends[:-1] <= sorted_starts[1:]):
+        # Disjoint intervals: find the last interval starting before each
+        # point and keep the point if it also ends at or after it
+        idx = np.searchsorted(sorted_starts, points, side="left") - 1
+        inside = idx >= 0
+        inside[inside] = points[inside] <= sorted_ends[idx[inside]]
+        out[inside] = labels[order][idx[inside]]
+        return out
+
+    # Overlapping intervals: locate each interval's run of sorted points
+    # and assign in input order so later intervals win
+    point_order = np.argsort(points, kind="stable")
+    sorted_points = points[point_order]
+    lo = np.searchsorted(sorted_points, starts, side="right")
+    hi = np.searchsorted(sorted_points, ends, side="right")
+    for i in np.sort(order):
+        out[point_order[lo[i]:hi[i]]] = labels[i]
+    return out
@@ -0,0 +1,70 @@
+''' Incrementally read the large JSON array exports written by fitbit '''
+
+import json
+
+CHUNK_BYTES = 1 << 20  # Read the file 1MB at a time
+WHITESPACE = " \t\n\r"
+
+
+def iter_json_array(fn, chunk_bytes=CHUNK_BYTES):
+    '''
+    Yields the objects of a top level JSON array one at a time
+
+    Only the current read buffer and the object being decoded are held in
+    memory, so peak memory does not grow with the size of the file.
+
+            Parameters:
+                    fn (str): Filename of a json file containing one array
+                    chunk_bytes (int): Number of characters to read at a time
+
+            Yields:
+                    item: Each decoded element of the array, in file order
+    '''
+    decoder = json.JSONDecoder()
+    with open(fn) as f:
+        buf = f.read(chunk_bytes).lstrip(WHITESPACE)
+        if not buf.startswith("["):
+            raise ValueError("{} does not contain a JSON array".format(fn))
+        pos = 1
+        eof = False
+        while True:
+            # Skip separators between elements
+            while pos < len(buf) and buf[pos] in WHITESPACE + ",":
+                pos += 1
+            if pos < len(buf) and buf[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # Most likely the element straddles the end of the buffer
+                if eof:
+                    raise
+                more = f.read(chunk_bytes)
+                eof = not more
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+            yield item
+            pos = end
+
+
+def iter_json_array_chunks(fn, chunk_size, chunk_bytes=CHUNK_BYTES):
+    '''
+    Yields the objects of a top level JSON array in lists of chunk_size
+
+            Parameters:
+                    fn (str): Filename of a json file containing one array
+                    chunk_size (int): Maximum number of elements per list
+                    chunk_bytes (int): Number of characters to read at a time
+
+            Yields:
+                    chunk (list): Up to chunk_size decoded elements
+    '''
+    chunk = []
+    for item in iter_json_array(fn, chunk_bytes):
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
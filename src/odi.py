@@ -0,0 +1,95 @@
+""" Vectorized oxygen desaturation index (ODI) detectors.
+
+Each detector takes the sample times (datetime64) and SpO2 values of a time
+sorted recording and returns one flag per sample: 1 for samples that are
+part of an ODI event, 0 otherwise and np.nan where there is too little data
+to decide.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def _sorted(times, spo2):
+    """ Returns int64 ns times, float SpO2 and the order that sorts them """
+    times = np.asarray(times).astype("datetime64[ns]").view(np.int64)
+    spo2 = np.asarray(spo2, dtype=np.float64)
+    order = None
+    if np.any(times[1:] < times[:-1]):
+        order = np.argsort(times, kind="stable")
+        times, spo2 = times[order], spo2[order]
+    return times, spo2, order
+
+
+def _unsort(flags, order):
+    if order is None:
+        return flags
+    out = np.empty_like(flags)
+    out[order] = flags
+    return out
+
+
+def threshold_odi(times, spo2, bin_seconds=10, threshold=91.0, min_samples=2):
+    """ Flag fixed time bins where every SpO2 value is <= threshold
+    Bins are aligned to midnight, like pd.Grouper(freq="10S").
+    Arguments:
+        times: sample times
+        spo2: SpO2 values
+        bin_seconds: width of each bin
+        threshold: highest SpO2 that counts as desaturated
+        min_samples: bins with fewer samples are np.nan
+    Returns: float array of flags, one per sample
+    """
+    if len(times) == 0:
+        return np.empty(0)
+    times, spo2, order = _sorted(times, spo2)
+    codes = times // (bin_seconds * 10**9)
+    starts = np.flatnonzero(np.diff(codes, prepend=codes[0] - 1))
+    counts = np.diff(np.append(starts, len(codes)))
+    maxes = np.fmax.reduceat(spo2, starts)
+
+    bin_flags = (maxes <= threshold).astype(np.float64)
+    bin_flags[counts < min_samples] = np.nan
+    return _unsort(np.repeat(bin_flags, counts), order)
+
+
+def desaturation_odi(times, spo2, drop=4.0, min_seconds=10, baseline_seconds=120):
+    """ Flag drops of at least `drop` points below a rolling baseline
+    lasting at least min_seconds (the usual clinical ODI definition).
+    The baseline is the mean SpO2 over the preceding baseline_seconds.
+    Arguments:
+        times: sample times
+        spo2: SpO2 values
+        drop: SpO2 points below baseline that count as desaturated
+        min_seconds: shortest desaturation that counts as an event
+        baseline_seconds: length of the rolling baseline window
+    Returns: float array of flags, one per sample
+    """
+    if len(times) == 0:
+        return np.empty(0)
+    times, spo2, order = _sorted(times, spo2)
+    baseline = pd.Series(spo2, index=pd.DatetimeIndex(times)).rolling(
+        "{}s".format(baseline_seconds), closed="left").mean().values
+    low = spo2 <= baseline - drop
+
+    # Runs of consecutive desaturated samples. Each run lasts until the
+    # first sample after it (or the end of the recording).
+    edges = np.diff(low.astype(np.int8), prepend=0, append=0)
+    run_starts = np.flatnonzero(edges == 1)
+    run_stops = np.flatnonzero(edges == -1)
+    run_ends = times[np.minimum(run_stops, len(times) - 1)]
+    long_runs = (run_ends - times[run_starts]) >= min_seconds * 10**9
+
+    # Mark the long runs with a +1/-1 difference array and integrate
+    marks = np.zeros(len(times) + 1, dtype=np.int64)
+    np.add.at(marks, run_starts[long_runs], 1)
+    np.add.at(marks, run_stops[long_runs], -1)
+    flags = np.cumsum(marks[:-1]).astype(np.float64)
+    return _unsort(flags, order)
+
+
+# Keep recording.ODI_DETECTOR_NAMES, which the scripts' options use, in step
+ODI_DETECTORS = {
+    "threshold": threshold_odi,
+    "desaturation": desaturation_odi,
+}
@@ -3,23 +3,50 @@ Takes in data that has already been formatted in format_data.py,
 & runs Baum Welch algorithm to infer parameters
 '''
 
-from baum_welch_alg import BaumWelch
 import sys
+import os
+import json
 import argparse
 
-import pandas as pd
-import numpy as np
-import tensorflow as tf
-import tensorflow_probability as tfp
+# numpy and hmm are imported by the functions that need them, so --help
+# doesn't wait for them
+from storage import read_frame
 
-# This code is available at:
+# The TensorFlow engine's BaumWelch class is available at:
 # https://github.com/kimberlymcm/algorithm_practice/blob/master/weather_data_explorations/src/baum_welch_alg.py
-sys.path.append(
-    "/Users/kmcmanus/Documents/classes/algorithm_practice/weather_data_explorations/src")
+BAUM_WELCH_TF_DIR = "/Users/kmcmanus/Documents/classes/algorithm_practice/weather_data_explorations/src"
 
+ENGINES = ["numpy", "tensorflow"]
+SAMPLE_SPACING_MINUTES = 1  # format_data.py writes one row a minute
+CHUNK_SIZE = 10080  # A week of minutes
+NUM_STARTS = 20
 
-def run_random_start(args, observations):
-    ''' Run Baum Welch from different starting vals '''
+
+def fit_random_starts(args, observations, segments):
+    ''' Run Baum Welch from NUM_STARTS starting vals at once, with hmm.py '''
+    import numpy as np
+
+    import hmm
+
+    rng = np.random.default_rng(args.seed)
+    starts = [hmm.random_start(rng) for _ in range(NUM_STARTS)]
+    best, results = hmm.fit_restarts(observations, starts, epsilon=0.5, max_steps=50,
+                                     cull_margin=args.cull_margin, segments=segments,
+                                     chunk_size=args.chunk_size)
+
+    out_fn = os.path.join(args.out_dir, "hmm_restarts.json")
+    with open(out_fn, "w") as f:
+        json.dump({"best": hmm.params_to_dict(best), "restarts": results}, f, indent=2)
+    return best, results
+
+
+def run_random_start_tf(args, observations):
+    ''' Run Baum Welch from different starting vals, with TensorFlow '''
+    import numpy as np
+    import tensorflow_probability as tfp
+    if BAUM_WELCH_TF_DIR not in sys.path:
+        sys.path.append(BAUM_WELCH_TF_DIR)
+    from baum_welch_alg import BaumWelch
 
     num_steps = len(observations)
 
@@ -59,22 +86,42 @@ def run_random_start(args, observations):
 
 
 def main(args):
+    import numpy as np
 
-    df = pd.read_csv(args.in_file, index_col=0)
+    import hmm
+
+    df = read_frame(args.in_file, columns=["bpm"])
     print("Num rows: {}".format(df.shape[0]))
     df = df[~df['bpm'].isnull()]  # Drop minutes where there wasn't a reading
     print("Num rows after dropping null bpm: {}".format(df.shape[0]))
 
-    # Limit to about 2 weeks of data
-    observations = tf.constant(
-        df['bpm'][0:20160], dtype=tf.float32, name='observation_sequence')
-
-    for i in range(0, 20):
-        run_random_start(args, observations)
-
-
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+    df = df.iloc[0:args.max_obs]
+    observations = df['bpm'].to_numpy(dtype=np.float64)
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    if args.engine == "tensorflow":
+        import tensorflow as tf
+        observations = tf.constant(
+            observations, dtype=tf.float32, name='observation_sequence')
+        for i in range(0, NUM_STARTS):
+            run_random_start_tf(args, observations)
+        return
+
+    # Minutes without a reading split the data into independent segments
+    segments = hmm.contiguous_segments(df.index.values,
+                                       np.timedelta64(SAMPLE_SPACING_MINUTES, "m"))
+    print("Fitting {} observations in {} segments".format(len(observations),
+                                                         len(segments[0])))
+    best, results = fit_random_starts(args, observations, segments)
+    for i, result in enumerate(results):
+        print("Start {}: {} with log likelihood {:.1f} after {} steps".format(
+            i, result["status"], result["log_likelihood"][-1], len(result["log_likelihood"])))
+    print("Best fit: {}".format(hmm.params_to_dict(best)))
+
+
+def build_parser(prog=None):
+    ''' Command line arguments, also used by the digitalhealth.py subcommand '''
+    parser = argparse.ArgumentParser(prog=prog, description=__doc__)
     parser.add_argument(
         "--in_file",
         help="Input directory with heart rate data",
@@ -83,5 +130,38 @@ if __name__ == "__main__":
         "--out_dir",
         help="Output directory with heart rate data",
         default="/Users/kmcmanus/Documents/classes/digitalhealth_project/data/hmm_tf_logs")
-    args = parser.parse_args()
+    parser.add_argument(
+        "--engine",
+        help="hmm.py (numpy, uses numba when installed) or the TensorFlow BaumWelch class",
+        choices=ENGINES,
+        default="numpy")
+    parser.add_argument(
+        "--seed",
+        help="Random seed for the starting values of the numpy engine",
+        type=int,
+        default=None)
+    parser.add_argument(
+        "--max_obs",
+        help="Only fit the first max_obs readings (20160 is about 2 weeks), all of them by default",
+        type=int,
+        default=None)
+    parser.add_argument(
+        "--chunk_size",
+        help="Readings held in memory at once by the numpy engine's forward-backward pass",
+        type=int,
+        default=CHUNK_SIZE)
+    parser.add_argument(
+        "--cull_margin",
+        help="Stop numpy engine starts whose log likelihood falls this far behind the best",
+        type=float,
+        default=100.0)
+    return parser
+
+
+def cli(argv=None, prog=None):
+    args = build_parser(prog).parse_args(argv)
     main(args)
+
+
+if __name__ == "__main__":
+    cli()
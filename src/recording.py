@@ -0,0 +1,58 @@
+""" Settings of the sleep recordings shared by the command line scripts.
+
+This module doesn't import numpy or pandas at load time, so the scripts can
+build their command line options from it and answer --help quickly.
+"""
+
+# Time zone the SomnoPose recordings were made in
+DEFAULT_TIMEZONE = "America/Los_Angeles"
+# Time of day that each sleep night starts at
+NIGHT_CUTOFF = "17:00"
+# Names of the detectors in odi.ODI_DETECTORS
+ODI_DETECTOR_NAMES = ["desaturation", "threshold"]
+
+
+def parse_night_cutoff(cutoff):
+    """ Seconds after midnight of a night cutoff time of day.
+        Arguments: cutoff: "HH:MM" or "HH:MM:SS" string
+        Returns: int seconds
+        Raises ValueError if cutoff isn't a valid time of day
+    """
+    parts = str(cutoff).split(":")
+    if len(parts) not in (2, 3) or not all(x.isdigit() for x in parts):
+        raise ValueError("Night cutoff must be HH:MM or HH:MM:SS, got {!r}".format(cutoff))
+    hours, minutes, seconds = (int(x) for x in parts + ["0"] * (3 - len(parts)))
+    if hours > 23 or minutes > 59 or seconds > 59:
+        raise ValueError("Night cutoff {!r} is not a time of day".format(cutoff))
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def parse_bucket(bucket):
+    """ Seconds in a time bucket width.
+        Arguments: bucket: anything pd.Timedelta accepts, e.g. "5s" or "1min"
+        Returns: int seconds
+        Raises ValueError unless the width is a whole number of seconds
+        that divides an hour, as the complete hour counts need
+    """
+    import pandas as pd
+
+    seconds = pd.Timedelta(bucket).total_seconds()
+    if seconds <= 0 or seconds != int(seconds) or 3600 % int(seconds):
+        raise ValueError("Bucket width must be whole seconds that divide an hour, "
+                         "got {!r}".format(bucket))
+    return int(seconds)
+
+
+def sleep_night_days(index, cutoff=NIGHT_CUTOFF):
+    """ Day number (days since 1970-01-01) of the sleep night each time falls in.
+        A night runs from the cutoff time on one date to just before
+        the cutoff on the next.
+        Arguments: index: DatetimeIndex or datetime64 values
+                   cutoff: "HH:MM" time of day that nights start at
+        Returns: int32 numpy array
+    """
+    import numpy as np
+
+    offset = np.timedelta64(parse_night_cutoff(cutoff), "s")
+    times = np.asarray(index).astype("datetime64[ns]")
+    return (times - offset).astype("datetime64[D]").astype(np.int64).astype(np.int32)
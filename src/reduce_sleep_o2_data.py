@@ -5,80 +5,125 @@ additional modifications
 
 import click
 
-import pandas as pd
-import numpy as np
+# numpy and the modules using it are imported by the functions that need
+# them, so --help doesn't wait for them
+from storage import read_frame, write_frame
 
+# Side to side angle of the sleep position device, see binning.py
+ORIENTATION_BINS = {
+    "edges": [-361, -60, 40, float("inf")],
+    "labels": [1, 0, -1],  # Left, Back, Right
+}
 
-def add_orient_oxy_bin(df):
-    """ Bin the orientation and oxygen data """
-    df["orient_bin"] = None
-    df.loc[df["Orientation"] > 40, "orient_bin"] = -1  # Right
-    df.loc[(df["Orientation"] > -60) &
-           (df["Orientation"] <= 40), "orient_bin"] = 0  # Back
-    df.loc[(df["Orientation"] > -
-            361) & (df["Orientation"] <= -
-                    60), "orient_bin"] = 1  # Left
-
-    df["low_oxygen"] = 0  # Not low
-    df.loc[df["SpO2(%)"] <= 88, "low_oxygen"] = 1  # Yes low oxygen
-    return df
+LOW_OXYGEN_BINS = {
+    "edges": [-float("inf"), 88, float("inf")],
+    "labels": [1, 0],  # Yes low oxygen, Not low
+    "fill": 0,
+}
 
 
-def add_timing_info(df):
-    """ Add extra columns about timing that will be used for graphing """
-
-    # This is so hacky. There has to be a better way.
-    df["hour"] = None
-    df.loc[:, "hour"] = [str(x) if x > 10 else "0" + str(x)
-                         for x in df.index.hour]
-    num_measurements_per_hour = df.groupby(
-        [df.index.date, df["hour"]]).count().reset_index()
-    hours_to_use_df = num_measurements_per_hour[num_measurements_per_hour["Orientation"] == 720]
-    hours_to_use_str = hours_to_use_df["level_0"].astype(
-        str) + " " + hours_to_use_df["hour"].astype(str)
-    hours_to_use_datetime = pd.to_datetime(
-        hours_to_use_str, format='%Y-%m-%d %H')
-
-    df["complete_hour"] = 0
-    df.loc[df.index.floor("H").isin(
-        hours_to_use_datetime), "complete_hour"] = 1
+def add_orient_oxy_bin(df):
+    """ Bin the orientation and oxygen data """
+    from binning import bin_column
 
-    min_night_length = 720 * 5
-    df_num = df.groupby("sleep_night")["hour"].count()
-    df_num_to_use = df_num.loc[df_num >= min_night_length]
+    df["orient_bin"] = bin_column(df["Orientation"], ORIENTATION_BINS)
+    df["low_oxygen"] = bin_column(df["SpO2(%)"], LOW_OXYGEN_BINS)
+    return df
 
-    df["complete_night"] = 0
-    df.loc[df["sleep_night"].isin(df_num_to_use.index), "complete_night"] = 1
 
-    # Counts number of time points since position started
-    df["time_since_pos_start"] = df.groupby(["sleep_night", (df["orient_bin"] != df["orient_bin"].shift()).cumsum()]).cumcount() + 1
+# Hours of samples in a night for it to count as complete
+MIN_NIGHT_HOURS = 5
+
+
+def add_timing_info(df, bucket_seconds):
+    """ Add extra columns about timing that will be used for graphing
+        All three columns come from integer keys in one pass over the rows:
+        hours since the epoch for complete_hour, the sleep_night codes for
+        complete_night, and the starts of runs of the same orient_bin
+        within a night, with no gap in the grid, for time_since_pos_start.
+        Arguments: df: dataframe with a sorted DatetimeIndex, Orientation,
+            orient_bin and sleep_night columns
+                   bucket_seconds: width of the buckets of the grid, it
+            must divide an hour
+        Returns: df with hour, complete_hour, complete_night and
+            time_since_pos_start columns added
+    """
+    import numpy as np
+
+    from episodes import column_codes, gap_codes, run_positions, run_starts
+
+    if 3600 % bucket_seconds:
+        raise ValueError("{}s buckets don't divide an hour".format(bucket_seconds))
+    samples_per_hour = 3600 // bucket_seconds
+
+    n = len(df)
+    ns = np.asarray(df.index.values).astype("datetime64[ns]").view(np.int64)
+    night_codes = column_codes(df["sleep_night"])
+    orient_codes = column_codes(df["orient_bin"])
+
+    # Hours since the epoch, the index holds naive local times
+    hour_key = ns // (3600 * 10**9)
+    df["hour"] = (hour_key % 24).astype(np.int8)
+
+    # Hours with a position reading in every bucket
+    if n:
+        hour_key = hour_key - hour_key.min()
+    has_orientation = df["Orientation"].notna().to_numpy()
+    per_hour = np.bincount(hour_key, weights=has_orientation)
+    df["complete_hour"] = (per_hour[hour_key] == samples_per_hour).astype(np.int64)
+
+    # Nights with enough rows, rows without a night are never complete
+    in_night = night_codes >= 0
+    per_night = np.bincount(night_codes[in_night], minlength=1)
+    complete = np.zeros(n, dtype=np.int64)
+    complete[in_night] = per_night[night_codes[in_night]] >= samples_per_hour * MIN_NIGHT_HOURS
+    df["complete_night"] = complete
+
+    # Counts number of time points since position started. Position runs
+    # are the episodes of episodes.py: a new one starts when the bin or
+    # the night changes or after a gap in the grid, and every row with no
+    # bin is a run of its own.
+    since_start = run_positions(run_starts(orient_codes, night_codes,
+                                           gap_codes(df.index.values, bucket_seconds)))
+    if not in_night.all():
+        since_start = np.where(in_night, since_start, np.nan)
+    df["time_since_pos_start"] = since_start
 
     return df
 
 
-
 @click.command()
 @click.option(
     "--in_file",
-    help="File with merged sleep data (from format_sleep_o2_data.py.",
+    help="File or column cache directory with merged sleep data (from format_sleep_o2_data.py).",
     default="/Users/kmcmanus/Documents/classes/digitalhealth_project/data/formatted_data/20200628_sleep_pos_5S.csv")
 @click.option(
     "--out_file",
-    help="Outfile name",
+    help="Outfile name, the extension (.csv, .parquet or .feather) sets the format",
     default="/Users/kmcmanus/Documents/classes/digitalhealth_project/data/formatted_data/20200628_sleep_pos_5S_cleaned.csv")
-def main(in_file, out_file):
-    df = pd.read_csv(
-        in_file,
-        index_col='datetime',
-        parse_dates=True,
-        infer_datetime_format=True)
+@click.option(
+    "--episodes_file",
+    help="Optional outfile for the table of sleep position episodes (see episodes.py)",
+    default=None)
+def main(in_file, out_file, episodes_file):
+    from episodes import infer_bucket_seconds
+
+    df = read_frame(in_file)
+    # Before rows are dropped below, so neighbouring buckets are still there
+    bucket_seconds = infer_bucket_seconds(df.index.values)
+    print("Bucket width (from the index): {}s".format(bucket_seconds))
 
     #df_subset = df.dropna()  # Drop any rows that don't have both measurements
     df_subset = df[~df["SpO2(%)"].isna()] # Drop any rows that don't have at least oxygen data
     print(df_subset.head())
     df_subset = add_orient_oxy_bin(df_subset)
-    df_subset = add_timing_info(df_subset)
-    df_subset.to_csv(out_file)
+    df_subset = add_timing_info(df_subset, bucket_seconds)
+    write_frame(df_subset, out_file)
+    if episodes_file is not None:
+        from episodes import position_episodes
+        episodes = position_episodes(df_subset, bucket_seconds)
+        episodes.index.name = "episode"
+        write_frame(episodes, episodes_file)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,153 @@
+""" Read and write the dataframes exchanged between the formatting scripts.
+
+The format is chosen from the file extension:
+    .csv: plain text, readable anywhere but slow and untyped
+    .parquet: directory of parquet files partitioned by date (needs pyarrow)
+    .feather: single Arrow IPC file (needs pyarrow)
+    .mmap: directory of memory mapped numpy columns (see column_cache.py)
+The columnar formats keep dtypes and the DatetimeIndex, so readers skip
+datetime parsing and can load just the columns they need.
+
+pandas, pyarrow and column_cache are imported when a frame is read or
+written, so scripts can import this module for BACKENDS and still answer
+--help quickly.
+"""
+
+import os
+import shutil
+
+PARTITION_COLUMN = "date"
+INDEX_COLUMN = "__index__"
+
+
+def _require_pyarrow(fmt):
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ImportError("pyarrow is required to use the {} format".format(fmt))
+
+
+def _read_csv(path, columns=None, dates=None):
+    import pandas as pd
+    usecols = None
+    if columns is not None:
+        index_col = pd.read_csv(path, nrows=0).columns[0]
+        usecols = [index_col] + list(columns)
+    df = pd.read_csv(path, index_col=0, parse_dates=True, usecols=usecols)
+    if dates is not None:
+        df = df[df.index.normalize().isin(pd.to_datetime(dates))]
+    return df
+
+
+def _write_csv(df, path):
+    df.to_csv(path)
+
+
+def _read_parquet(path, columns=None, dates=None):
+    import pandas as pd
+    _require_pyarrow("parquet")
+    filters = None
+    if dates is not None:
+        dates = [pd.Timestamp(x).strftime("%Y-%m-%d") for x in dates]
+        filters = [(PARTITION_COLUMN, "in", dates)]
+    df = pd.read_parquet(path, columns=columns, filters=filters)
+    if PARTITION_COLUMN in df.columns and (
+            columns is None or PARTITION_COLUMN not in columns):
+        df = df.drop(columns=PARTITION_COLUMN)
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index(kind="stable")
+    return df
+
+
+def _write_parquet(df, path):
+    """ Writes a date partitioned dataset, replacing any existing one """
+    import pandas as pd
+    _require_pyarrow("parquet")
+    partition_cols = None
+    if isinstance(df.index, pd.DatetimeIndex):
+        df = df.assign(**{PARTITION_COLUMN: df.index.strftime("%Y-%m-%d")})
+        partition_cols = [PARTITION_COLUMN]
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    df.to_parquet(tmp_path, partition_cols=partition_cols)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+    os.replace(tmp_path, path)
+
+
+def _read_feather(path, columns=None, dates=None):
+    import pandas as pd
+    _require_pyarrow("feather")
+    import pyarrow.ipc
+    # The index is stored as the first column, under its own name if it has one
+    index_col = pyarrow.ipc.open_file(path).schema.names[0]
+    if columns is not None:
+        columns = [index_col] + list(columns)
+    df = pd.read_feather(path, columns=columns).set_index(index_col)
+    if index_col == INDEX_COLUMN:
+        df.index.name = None
+    if dates is not None:
+        df = df[df.index.normalize().isin(pd.to_datetime(dates))]
+    return df
+
+
+def _write_feather(df, path):
+    _require_pyarrow("feather")
+    if df.index.name is None or df.index.name in df.columns:
+        df = df.rename_axis(INDEX_COLUMN)
+    df.reset_index().to_feather(path)
+
+
+def _read_mmap(path, columns=None, dates=None):
+    from column_cache import ColumnCache
+    return ColumnCache(path).load(columns=columns, dates=dates, copy=True)
+
+
+def _write_mmap(df, path):
+    from column_cache import write_column_cache
+    write_column_cache(df, path)
+
+
+BACKENDS = {
+    "csv": (_read_csv, _write_csv),
+    "parquet": (_read_parquet, _write_parquet),
+    "feather": (_read_feather, _write_feather),
+    "mmap": (_read_mmap, _write_mmap),
+}
+
+
+def infer_format(path):
+    """ Returns the storage format implied by the extension of path """
+    from column_cache import is_column_cache
+    if is_column_cache(path):
+        return "mmap"
+    fmt = os.path.splitext(path.rstrip("/"))[1].lstrip(".").lower()
+    if fmt not in BACKENDS:
+        raise ValueError("Unknown storage format for {}, expected one of {}".format(
+            path, ", ".join(BACKENDS)))
+    return fmt
+
+
+def read_frame(path, columns=None, dates=None):
+    """ Read a dataframe written by write_frame
+        Arguments:
+            path: file or directory name, the extension selects the format
+            columns: optional list of columns to load, the index is always loaded
+            dates: optional list of dates to load rows for
+        Returns: dataframe with a DatetimeIndex
+    """
+    reader, _ = BACKENDS[infer_format(path)]
+    return reader(path, columns=columns, dates=dates)
+
+
+def write_frame(df, path):
+    """ Write a dataframe with a DatetimeIndex
+        Arguments:
+            df: dataframe to write
+            path: file or directory name, the extension selects the format
+    """
+    _, writer = BACKENDS[infer_format(path)]
+    writer(df, path)
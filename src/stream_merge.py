@@ -0,0 +1,96 @@
+""" Merge time sorted sensor streams onto fixed width time buckets.
+
+Equivalent to resampling each stream with .first() and outer merging the
+results, except that only buckets where at least one stream has a sample
+are emitted. The dense grid (mostly empty daytime hours) is never built,
+so memory scales with the number of samples rather than the time span.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def _bucket_first(df, width_ns):
+    """ First non-null value of each column in each occupied bucket
+        Arguments:
+            df: dataframe with a DatetimeIndex
+            width_ns: bucket width in nanoseconds
+        Returns: sorted int64 bucket codes, {column: values per bucket}
+    """
+    times = np.asarray(df.index.values).astype("datetime64[ns]").view(np.int64)
+    order = None
+    if np.any(times[1:] < times[:-1]):
+        order = np.argsort(times, kind="stable")
+        times = times[order]
+    if len(times) == 0:
+        return np.empty(0, dtype=np.int64), {name: df[name].to_numpy()
+                                             for name in df.columns}
+
+    codes = np.floor_divide(times, width_ns)
+    starts = np.flatnonzero(np.diff(codes, prepend=codes[0] - 1))
+    n = len(times)
+
+    columns = {}
+    for name in df.columns:
+        values = df[name].to_numpy()
+        if order is not None:
+            values = values[order]
+        valid = ~pd.isna(values)
+        if valid.all():
+            columns[name] = values[starts]
+            continue
+        # Position of the first valid value in each bucket, n if there is none
+        first = np.minimum.reduceat(np.where(valid, np.arange(n), n), starts)
+        picked = values[np.minimum(first, n - 1)]
+        columns[name] = np.where(first < n, picked, np.nan)
+    return codes[starts], columns
+
+
+def _missing_dtype(dtype):
+    """ dtype that can hold NaN for a column of the given dtype """
+    if dtype.kind in "fO":
+        return dtype
+    if dtype.kind in "iub" and dtype.itemsize <= 2:
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+
+def bucket_merge(frames, freq="5s", tolerance=None):
+    """ Merge dataframes onto the time buckets where any of them has data
+        Arguments:
+            frames: list of dataframes with a DatetimeIndex and distinct columns
+            freq: bucket width, anything pd.Timedelta accepts
+            tolerance: if set, a bucket with no sample from a stream takes
+                that stream's most recent bucket at most this long before it
+        Returns: dataframe indexed by bucket start, named "datetime"
+    """
+    names = [name for df in frames for name in df.columns]
+    if len(set(names)) != len(names):
+        raise ValueError("Frames to merge share column names")
+    width_ns = pd.Timedelta(freq).value
+    max_lag = 0 if tolerance is None else pd.Timedelta(tolerance).value // width_ns
+
+    streams = [_bucket_first(df, width_ns) for df in frames]
+    # Each stream's codes are sorted, so a stable sort merges the runs
+    all_codes = np.sort(np.concatenate([codes for codes, _ in streams]), kind="stable")
+    keep = np.ones(len(all_codes), dtype=bool)
+    keep[1:] = all_codes[1:] != all_codes[:-1]
+    buckets = all_codes[keep]
+
+    out = {}
+    for codes, columns in streams:
+        # As-of match: latest bucket of this stream at or before each output bucket
+        idx = np.searchsorted(codes, buckets, side="right") - 1
+        matched = idx >= 0
+        matched[matched] = buckets[matched] - codes[idx[matched]] <= max_lag
+        for name, values in columns.items():
+            if matched.all():
+                out[name] = values[idx]
+                continue
+            merged = np.full(len(buckets), np.nan, dtype=_missing_dtype(values.dtype))
+            merged[matched] = values[idx[matched]]
+            out[name] = merged
+
+    index = pd.DatetimeIndex((buckets * width_ns).astype("datetime64[ns]"),
+                             name="datetime")
+    return pd.DataFrame(out, index=index)
@@ -0,0 +1,76 @@
+""" Fast decoding of the timestamps written by the sleep recording devices """
+
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from recording import DEFAULT_TIMEZONE
+
+# SomnoPose timestamps are seconds since the first instant of 1 January 2001, GMT
+APPLE_EPOCH = np.datetime64("2001-01-01T00:00:00", "ns")
+
+O2RING_TIME_FORMAT = "%H:%M:%S %b %d %Y"
+O2RING_DATE_FORMAT = "%b %d %Y"
+
+
+def apple_epoch_to_datetime(seconds, tz=DEFAULT_TIMEZONE):
+    """ Convert seconds since the Apple reference epoch to local times
+        Fractions of a second are dropped, to match the device's
+        human readable Time_of_day column.
+        Arguments:
+            seconds: array-like of float seconds since 2001-01-01 GMT
+            tz: time zone the recording was made in, or None to stay in UTC
+        Returns: timezone naive DatetimeIndex of local times
+    """
+    seconds = np.floor(np.asarray(seconds, dtype=np.float64)).astype(np.int64)
+    index = pd.DatetimeIndex(APPLE_EPOCH + seconds.astype("timedelta64[s]"))
+    if tz is not None:
+        index = index.tz_localize("UTC").tz_convert(tz).tz_localize(None)
+    return index
+
+
+def _parse_o2ring_date(date_bytes):
+    """ Parse one 'Mon DD YYYY' date, as bytes, to datetime64[D] """
+    date = datetime.datetime.strptime(date_bytes.decode(), O2RING_DATE_FORMAT)
+    return np.datetime64(date.date(), "D")
+
+
+def parse_o2ring_times(values):
+    """ Parse O2Ring "HH:MM:SS Mon DD YYYY" strings
+        The time of day is decoded from the fixed position digits with
+        integer arithmetic, and each distinct date (a handful per
+        recording) is parsed only once. Anything that doesn't fit the
+        fixed layout falls back to pd.to_datetime.
+        Arguments: values: array-like of strings
+        Returns: DatetimeIndex
+    """
+    values = np.asarray(values)
+    try:
+        raw = values.astype("S")
+    except (UnicodeEncodeError, ValueError):
+        return pd.DatetimeIndex(pd.to_datetime(values, format=O2RING_TIME_FORMAT))
+    width = raw.dtype.itemsize
+    if len(raw) == 0 or width <= 9:
+        return pd.DatetimeIndex(pd.to_datetime(values, format=O2RING_TIME_FORMAT))
+
+    chars = raw.view(np.uint8).reshape(len(raw), width)
+    fixed_layout = (np.all(chars[:, [2, 5]] == ord(":")) and
+                    np.all(chars[:, 8] == ord(" ")))
+    digits = chars[:, [0, 1, 3, 4, 6, 7]].astype(np.int64) - ord("0")
+    if not fixed_layout or digits.min() < 0 or digits.max() > 9:
+        return pd.DatetimeIndex(pd.to_datetime(values, format=O2RING_TIME_FORMAT))
+
+    seconds = ((digits[:, 0] * 10 + digits[:, 1]) * 3600 +
+               (digits[:, 2] * 10 + digits[:, 3]) * 60 +
+               digits[:, 4] * 10 + digits[:, 5])
+    date_part = np.ascontiguousarray(chars[:, 9:]).view("S{}".format(width - 9)).ravel()
+    unique_dates, date_codes = np.unique(date_part, return_inverse=True)
+    try:
+        days = np.array([_parse_o2ring_date(x) for x in unique_dates])
+    except ValueError:
+        return pd.DatetimeIndex(pd.to_datetime(values, format=O2RING_TIME_FORMAT))
+
+    times = (days[date_codes.ravel()].astype("datetime64[ns]") +
+             seconds.astype("timedelta64[s]"))
+    return pd.DatetimeIndex(times)
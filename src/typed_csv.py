@@ -0,0 +1,177 @@
+""" Read device CSV exports with explicit, narrow column types.
+
+Each schema lists the columns to keep and either their dtype or the name of
+a timestamp converter in CONVERTERS. Files are read in chunks (with
+pyarrow's streaming reader when it is installed) straight into output
+arrays that are allocated once, so a set of files is never held in memory
+twice the way a list of frames plus pd.concat is. Timestamp columns are
+decoded chunk by chunk, so their strings never all exist at once.
+"""
+
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from timestamps import parse_o2ring_times
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
+CHUNK_ROWS = 100000
+BLOCK_BYTES = 1 << 22
+
+# Converters from a chunk of strings to datetime64[ns] values
+CONVERTERS = {
+    "o2ring_time": parse_o2ring_times,
+}
+
+SCHEMAS = {
+    # Wellue O2Ring oximeter, one row every 4 seconds
+    "o2ring": {
+        "columns": {
+            "Time": "o2ring_time",
+            "SpO2(%)": "uint8",
+            "Pulse Rate(bpm)": "int16",
+            "Motion": "uint8",
+            "Vibration": "uint8",
+        },
+        # Older exports misspell the pulse rate column
+        "aliases": {"Pulse Rate(bmp)": "Pulse Rate(bpm)"},
+    },
+    # SomnoPose sleep position app. Time_of_day and Date are derived from
+    # Timestamp, so they are not read.
+    "somnopose": {
+        "columns": {
+            "Timestamp": "float64",
+            "Orientation": "float32",
+            "Inclination": "float32",
+        },
+    },
+}
+
+
+def count_rows(fn):
+    """ Upper bound on the number of data rows in a CSV file """
+    n_lines = 0
+    last = b"\n"
+    with open(fn, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_BYTES), b""):
+            n_lines += block.count(b"\n")
+            last = block[-1:]
+    if last != b"\n":
+        n_lines += 1  # No newline after the last row
+    return max(n_lines - 1, 0)
+
+
+def _file_columns(fn, schema):
+    """ Returns {name in file: name in schema} for the columns to read """
+    header = pd.read_csv(fn, nrows=0).columns
+    aliases = schema.get("aliases", {})
+    names = {}
+    for name in header:
+        canonical = aliases.get(name, name)
+        if canonical in schema["columns"]:
+            names[name] = canonical
+    missing = set(schema["columns"]) - set(names.values())
+    if missing:
+        raise ValueError("{} is missing columns {}".format(fn, sorted(missing)))
+    return names
+
+
+def _required(dtypes, canonical):
+    """
+    Whether a row needs a value in a column. Blank cells in float columns
+    are read as NaN for the caller to drop, integer and timestamp columns
+    have no missing value, so rows with a blank there are skipped.
+    """
+    dtype = dtypes[canonical]
+    return dtype in CONVERTERS or np.dtype(dtype).kind != "f"
+
+
+def _warn_skipped(fn, n_skipped):
+    if n_skipped:
+        warnings.warn("Skipped {} rows of {} with blank values".format(n_skipped, fn))
+
+
+def _iter_chunks_pyarrow(fn, names, dtypes, chunksize):
+    column_types = {name: pa.string() if dtypes[canonical] in CONVERTERS
+                    else pa.from_numpy_dtype(np.dtype(dtypes[canonical]))
+                    for name, canonical in names.items()}
+    required = [name for name, canonical in names.items() if _required(dtypes, canonical)]
+    reader = pa_csv.open_csv(
+        fn,
+        read_options=pa_csv.ReadOptions(block_size=BLOCK_BYTES),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=list(names), column_types=column_types,
+            # Blank timestamp cells are nulls, as they are for pandas
+            strings_can_be_null=True))
+    n_skipped = 0
+    for batch in reader:
+        if any(batch.column(name).null_count for name in required):
+            valid = np.ones(batch.num_rows, dtype=bool)
+            for name in required:
+                valid &= batch.column(name).is_valid().to_numpy(zero_copy_only=False)
+            n_skipped += batch.num_rows - int(valid.sum())
+            batch = batch.filter(pa.array(valid))
+        yield {canonical: batch.column(name).to_numpy(zero_copy_only=False)
+               for name, canonical in names.items()}
+    _warn_skipped(fn, n_skipped)
+
+
+def _iter_chunks_pandas(fn, names, dtypes, chunksize):
+    # Integer columns are read as floats, so blanks can be found and skipped
+    # before the cast
+    dtype = {name: object if dtypes[canonical] in CONVERTERS
+             else "float64" if _required(dtypes, canonical) else dtypes[canonical]
+             for name, canonical in names.items()}
+    required = [name for name, canonical in names.items() if _required(dtypes, canonical)]
+    n_skipped = 0
+    for frame in pd.read_csv(fn, usecols=list(names), dtype=dtype,
+                             chunksize=chunksize):
+        n_rows = len(frame)
+        frame = frame.dropna(subset=required)
+        n_skipped += n_rows - len(frame)
+        yield {canonical: frame[name].to_numpy() if dtypes[canonical] in CONVERTERS
+               else frame[name].to_numpy(dtype=dtypes[canonical])
+               for name, canonical in names.items()}
+    _warn_skipped(fn, n_skipped)
+
+
+ITER_CHUNKS = {"pyarrow": _iter_chunks_pyarrow, "pandas": _iter_chunks_pandas}
+
+
+def read_typed_csv(files, schema, chunksize=CHUNK_ROWS, engine=None):
+    """ Read CSV files into one dataframe with the dtypes of a schema
+        Arguments:
+            files: list of filenames
+            schema: name of a schema in SCHEMAS, or a schema dict
+            chunksize: rows per chunk when reading with pandas
+            engine: "pyarrow" or "pandas", by default pyarrow when it is installed
+        Returns: dataframe with the schema's columns, files in the order given
+    """
+    if isinstance(schema, str):
+        schema = SCHEMAS[schema]
+    dtypes = schema["columns"]
+    iter_chunks = ITER_CHUNKS[engine] if engine else (
+        _iter_chunks_pyarrow if pa is not None else _iter_chunks_pandas)
+
+    n_alloc = sum(count_rows(fn) for fn in files)
+    out = {name: np.empty(n_alloc, dtype="datetime64[ns]" if dtype in CONVERTERS else dtype)
+           for name, dtype in dtypes.items()}
+    n = 0
+    for fn in files:
+        names = _file_columns(fn, schema)
+        for chunk in iter_chunks(fn, names, dtypes, chunksize):
+            m = len(next(iter(chunk.values())))
+            for name, values in chunk.items():
+                if dtypes[name] in CONVERTERS:
+                    values = np.asarray(CONVERTERS[dtypes[name]](values),
+                                        dtype="datetime64[ns]")
+                out[name][n:n + m] = values
+            n += m
+    return pd.DataFrame({name: values[:n] for name, values in out.items()},
+                        copy=False)